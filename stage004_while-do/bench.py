@@ -0,0 +1,1162 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+import subprocess
+import shutil
+import contextlib
+import io
+import importlib.util
+
+import porth
+
+# Words that show up in generated programs, roughly the mix from examples/
+BENCH_WORDS = ["1", "2", "34", "35", "69", "420", "+", "-", "=", ">", ".", "dup", "if", "else", "end"]
+
+def parse_size(text):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    if text[-1].upper() in units:
+        return int(text[:-1]) * units[text[-1].upper()]
+    return int(text)
+
+def format_size(size):
+    for (unit, scale) in (("G", 1 << 30), ("M", 1 << 20), ("K", 1 << 10)):
+        if size >= scale:
+            return "%d%s" % (size // scale, unit)
+    return "%dB" % size
+
+# Write a file of random words of roughly `size` bytes, used for lexing only
+def generate_words_file(file_path, size, seed=69):
+    rng = random.Random(seed)
+    written = 0
+    with open(file_path, "w") as f:
+        while written < size:
+            indent = "\t" * rng.randint(0, 3)
+            line = indent + " ".join(rng.choice(BENCH_WORDS) for _ in range(rng.randint(0, 10))) + "\n"
+            f.write(line)
+            written += len(line)
+
+# Write a file of exactly `count` random words
+def generate_tokens_file(file_path, count, seed=69):
+    rng = random.Random(seed)
+    with open(file_path, "w") as f:
+        while count > 0:
+            line = [rng.choice(BENCH_WORDS) for _ in range(min(count, rng.randint(1, 10)))]
+            f.write(" ".join(line) + "\n")
+            count -= len(line)
+
+# Write a program of roughly `size` bytes around one running value. Each
+# statement adds to it and takes from it, `branches` of them instead compare
+# it in an if whose then branch is a statement again, down to `depth` levels.
+# Every `dump_every`th statement dumps the value. There is no loop keyword yet,
+# so a loop is its body written out `trips` times, the way it would run.
+def generate_workload_file(file_path, size, depth=4, branches=0.2, trips=1, dump_every=8, seed=69):
+    rng = random.Random(seed)
+    statements = 0
+    def statement(level):
+        nonlocal statements
+        statements += 1
+        indent = "\t" * level
+        if level < depth and rng.random() < branches:
+            text = "%sdup %d > if\n%s%selse\n%s%send\n" % (indent, rng.randint(0, 1000), statement(level + 1), indent, statement(depth), indent)
+        else:
+            text = "%s%d + %d -\n" % (indent, rng.randint(0, 1000), rng.randint(0, 1000))
+        if statements % dump_every == 0:
+            text += "%sdup .\n" % indent
+        return text
+    written = 0
+    with open(file_path, "w") as f:
+        f.write("0\n")
+        while written < size:
+            body = "".join(statement(0) for _ in range(rng.randint(1, 4)))
+            f.write(body * trips)
+            written += len(body) * trips
+        f.write(".\n")
+
+# Parameters of generate_workload_file for the programs the benchmarks run:
+# small if/else blocks, straight-line arithmetic and ifs nested 8 deep
+PROGRAM_KINDS = {
+    "blocks": {"depth": 1, "branches": 0.5},
+    "arithmetic": {"depth": 0, "branches": 0.0, "dump_every": 2},
+    "nested": {"depth": 8, "branches": 0.9},
+}
+
+# Writes the `kind` program of roughly `size` bytes to tmp/<name>.porth, gives back its path
+def write_workload(tmp, name, size, kind="blocks", **params):
+    file_path = os.path.join(tmp, "%s.porth" % name)
+    generate_workload_file(file_path, size, **dict(PROGRAM_KINDS[kind], **params))
+    return file_path
+
+# Same as write_workload and loads the program ready to simulate or compile,
+# gives back (file path, program)
+def load_workload(tmp, name, size, kind="blocks", **params):
+    file_path = write_workload(tmp, name, size, kind, **params)
+    program = porth.load_program_from_file(file_path)
+    porth.analyze_stack(program)
+    return (file_path, program)
+
+# The scanner lex_file used before the single pass lexer, kept as the baseline
+def find_col(line, start, predicate):
+    while start < len(line) and not predicate(line[start]):
+        start += 1
+    return start
+
+def lex_line(line):
+    col = find_col(line, 0, lambda x: not x.isspace())
+    while col < len(line):
+        col_end = find_col(line, col, lambda x: x.isspace())
+        yield (col, line[col:col_end])
+        col = find_col(line, col_end, lambda x: not x.isspace())
+
+def lex_file_by_line(file_path):
+    with open(file_path, "r") as f:
+        return [(file_path, row, col, token)
+                for (row, line) in enumerate(f.readlines())
+                for (col, token) in lex_line(line)]
+
+def timed(fun, *args):
+    start = time.perf_counter()
+    result = fun(*args)
+    return (time.perf_counter() - start, result)
+
+def bench_lex(sizes):
+    print("%8s %10s %12s %12s %8s" % ("size", "tokens", "lex_line", "lex_file", "speedup"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            file_path = os.path.join(tmp, "words_%d.porth" % size)
+            generate_words_file(file_path, size)
+            (old_time, old_tokens) = timed(lex_file_by_line, file_path)
+            (new_time, new_tokens) = timed(lambda p: list(porth.lex_file(p)), file_path)
+            assert old_tokens == new_tokens, "lex_file and lex_line disagree on %s" % file_path
+            print("%8s %10d %11.3fs %11.3fs %7.1fx" % (format_size(size), len(new_tokens), old_time, new_time, old_time / new_time))
+            del old_tokens, new_tokens
+
+# The if/elif parser from before the KEYWORDS table, kept as the baseline
+def parse_token_as_op_chain(token):
+    (file_path, row, col, word) = token
+    if word == '+':
+        return porth.plus()
+    elif word == '-':
+        return porth.minus()
+    elif word == '.':
+        return porth.dump()
+    elif word == '=':
+        return porth.equal()
+    elif word == 'if':
+        return porth.iff()
+    elif word == 'end':
+        return porth.end()
+    elif word == 'else':
+        return porth.elze()
+    elif word == 'dup':
+        return porth.dup()
+    elif word == '>':
+        return porth.gt()
+    else:
+        try:
+            return porth.push(int(word))
+        except ValueError as err:
+            print("%s:%d:%d: %s" % (file_path, row, col, err))
+            exit(1)
+
+def generate_parse_file(file_path, count, words, seed=69):
+    rng = random.Random(seed)
+    with open(file_path, "w") as f:
+        for _ in range(count // 8):
+            f.write(" ".join(rng.choice(words) for _ in range(8)) + "\n")
+
+def bench_parse(count):
+    literals = [str(n) for n in range(1000)]
+    keywords = list(porth.KEYWORDS)
+    print("%14s %10s %12s %12s %12s" % ("program", "tokens", "if/elif", "KEYWORDS", "batch"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for (name, words) in (("literal-heavy", literals * 9 + keywords), ("keyword-heavy", keywords * 9 + literals[:10])):
+            file_path = os.path.join(tmp, name + ".porth")
+            generate_parse_file(file_path, count, words)
+            tokens = list(porth.lex_file(file_path))
+            store = porth.lex_file_to_store(file_path)
+            (chain_time, chain_ops) = timed(lambda ts: [parse_token_as_op_chain(t) for t in ts], tokens)
+            (dict_time, dict_ops) = timed(lambda ts: [porth.parse_token_as_op(t) for t in ts], tokens)
+            (batch_time, batch_ops) = timed(porth.parse_tokens, store)
+            assert chain_ops == dict_ops == batch_ops
+            print("%14s %10d %11.3fs %11.3fs %11.3fs" % (name, len(tokens), chain_time, dict_time, batch_time))
+
+# simulate_program as it was on a list of op tuples, kept as the baseline.
+# Gives back the number of instructions it executed.
+def simulate_tuples(program):
+    stack = []
+    ip = 0
+    executed = 0
+    while ip < len(program):
+        executed += 1
+        op = program[ip]
+        if op[0] == porth.OP_PUSH:
+            stack.append(op[1])
+            ip += 1
+        elif op[0] == porth.OP_PLUS:
+            a = stack.pop()
+            b = stack.pop()
+            stack.append(a + b)
+            ip += 1
+        elif op[0] == porth.OP_MINUS:
+            a = stack.pop()
+            b = stack.pop()
+            stack.append(b - a)
+            ip += 1
+        elif op[0] == porth.OP_EQUAL:
+            a = stack.pop()
+            b = stack.pop()
+            stack.append(int(a == b))
+            ip += 1
+        elif op[0] == porth.OP_IF:
+            a = stack.pop()
+            if a == 0:
+                ip = op[1]
+            else:
+                ip += 1
+        elif op[0] == porth.OP_ELSE:
+            ip = op[1]
+        elif op[0] == porth.OP_END:
+            ip += 1
+        elif op[0] == porth.OP_DUMP:
+            a = stack.pop()
+            print(a)
+            ip += 1
+        elif op[0] == porth.OP_DUP:
+            a = stack.pop()
+            stack.append(a)
+            stack.append(a)
+            ip += 1
+        elif op[0] == porth.OP_GT:
+            a = stack.pop()
+            b = stack.pop()
+            stack.append(int(a < b))
+            ip += 1
+        else:
+            assert False, "unreachable"
+    return executed
+
+# Runs fun with stdout going nowhere, gives back (seconds, result)
+def timed_quiet(fun, *args):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        return timed(fun, *args)
+
+def bench_program(sizes):
+    print("%8s %10s %12s %12s %14s %14s" % ("size", "ops", "tuples", "Program", "sim(tuples)", "sim(Program)"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            file_path = write_workload(tmp, "program_%d" % size, size)
+            (program_size, _, program) = traced(porth.load_program_from_file, file_path)
+            (tuples_size, _, tuples) = traced(lambda p: [p[ip] for ip in range(len(p))], program)
+            (tuples_time, _) = timed_quiet(simulate_tuples, tuples)
+            (program_time, _) = timed_quiet(porth.simulate_program, program)
+            print("%8s %10d %11dK %11dK %9.2fMop/s %9.2fMop/s" % (format_size(size), len(program), tuples_size >> 10, program_size >> 10,
+                                                                  len(program) / tuples_time / 1e6, len(program) / program_time / 1e6))
+
+# Number of instructions a run executes, following the same jumps as the simulator
+def count_executed(program):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        return simulate_tuples([program[ip] for ip in range(len(program))])
+
+# Every engine split into a one time prepare step and a run that can be
+# repeated, repeating a run stands in for a long running loop
+def prepare_ladder(program, out):
+    return lambda: porth.simulate_program(program, out)
+
+def prepare_closure(program, out):
+    stack = []
+    blocks = porth.decode_program(program, stack, out.dump)
+    def run():
+        stack.clear()
+        porth.run_blocks(blocks)
+    return run
+
+def prepare_jit(program, out):
+    porth_jit = porth.jit_compile(program)
+    assert porth_jit is not None, "program could not be translated"
+    return lambda: porth_jit(out.dump)
+
+ENGINES = {
+    "ladder": prepare_ladder,
+    "closure": prepare_closure,
+    "jit": prepare_jit,
+}
+
+# Prepares an engine with its output captured and runs it `repeats` times,
+# gives back (prepare seconds, run seconds, output)
+def run_engine(prepare, program, repeats):
+    out = porth.SimOutput(capture=True)
+    (prepare_time, run) = timed(prepare, program, out)
+    (seconds, _) = timed(lambda: [run() for _ in range(repeats)])
+    return (prepare_time, seconds, out.getvalue())
+
+def bench_engines(sizes, repeats, kinds=("blocks", )):
+    print("%10s %8s %10s %10s" % ("program", "size", "ops", "executed") + "".join(" %10s %14s" % ("prepare", name) for name in ENGINES))
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in kinds:
+            for size in sizes:
+                (_, program) = load_workload(tmp, "%s_%d" % (kind, size), size, kind)
+                executed = count_executed(program) * repeats
+                row = "%10s %8s %10d %10d" % (kind, format_size(size), len(program), executed)
+                expected = None
+                for (name, prepare) in ENGINES.items():
+                    (prepare_time, seconds, output) = run_engine(prepare, program, repeats)
+                    if expected is None:
+                        expected = output
+                    assert output == expected, "%s engine output differs" % name
+                    row += " %9.3fs %9.2fMop/s" % (prepare_time, executed / seconds / 1e6)
+                print(row)
+
+# Ladder engine with and without the trace ring buffer, best of five runs each
+# sim --trace runs the closure engine, so that is what it is measured against
+def bench_trace(sizes, trace_sizes):
+    print("%8s %10s %14s" % ("size", "executed", "closure") + "".join(" %14s %9s" % ("trace=%d" % n, "overhead") for n in trace_sizes))
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            (_, program) = load_workload(tmp, "trace_%d" % size, size)
+            executed = count_executed(program)
+            out = porth.SimOutput(capture=True)
+            untraced = min(timed(porth.simulate_program_closure, program, out)[0] for _ in range(5))
+            expected = out.getvalue()
+            row = "%8s %10d %9.2fMop/s" % (format_size(size), executed, executed / untraced / 1e6)
+            for trace_size in trace_sizes:
+                out = porth.SimOutput(capture=True)
+                traced = min(timed(porth.trace_program, program, trace_size, out)[0] for _ in range(5))
+                assert out.getvalue() == expected, "traced output differs"
+                row += " %9.2fMop/s %8.0f%%" % (executed / traced / 1e6, 100 * (traced - untraced) / untraced)
+            print(row)
+
+def bench_fuse(sizes, repeats):
+    print("%10s %8s %10s %10s %12s %12s %12s %12s" % ("program", "size", "ops", "fused", "ladder", "+fuse", "closure", "+fuse"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in PROGRAM_KINDS:
+            for size in sizes:
+                (_, program) = load_workload(tmp, "%s_%d" % (kind, size), size, kind)
+                (fused, stats) = porth.fuse_program(program)
+                row = "%10s %8s %10d %10d" % (kind, format_size(size), len(program), len(fused))
+                expected = None
+                for prepare in (prepare_ladder, prepare_closure):
+                    for subject in (program, fused):
+                        (_, seconds, output) = run_engine(prepare, subject, repeats)
+                        if expected is None:
+                            expected = output
+                        assert output == expected, "fused program output differs"
+                        row += " %11.3fs" % seconds
+                print(row)
+                print("%10s %s" % ("", ", ".join("%s: %d" % (name, count) for (name, count) in stats.items())))
+
+def bench_dump(counts):
+    print("%10s %16s %16s %16s" % ("dumps", "print(buffered)", "print(line)", "SimOutput"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in counts:
+            file_path = os.path.join(tmp, "dump_%d.porth" % count)
+            with open(file_path, "w") as f:
+                for n in range(count):
+                    f.write("%d .\n" % n)
+            program = porth.load_program_from_file(file_path)
+            tuples = [program[ip] for ip in range(len(program))]
+            output_path = os.path.join(tmp, "output.txt")
+            row = "%10d" % count
+            for buffering in (-1, 1):
+                with open(output_path, "w", buffering=buffering) as output, contextlib.redirect_stdout(output):
+                    (seconds, _) = timed(simulate_tuples, tuples)
+                row += " %15.3fs" % seconds
+            expected = open(output_path, "rb").read()
+            with open(output_path, "wb") as output:
+                (seconds, _) = timed(porth.simulate_program, program, porth.SimOutput(output))
+            assert open(output_path, "rb").read() == expected, "SimOutput wrote something else than print"
+            row += " %15.3fs" % seconds
+            print(row)
+
+# Seeds the first literal of a nested program once per lane, the way it was
+# done before sim --batch: one scalar run per seed with the literal rewritten
+def simulate_seeds_scalar(program, ip, seeds, out):
+    args = program.args
+    original = args[ip]
+    try:
+        for seed in seeds:
+            args[ip] = seed
+            porth.simulate_program(program, out)
+    finally:
+        args[ip] = original
+
+def bench_batch(lane_counts, size):
+    if importlib.util.find_spec("numpy") is None:
+        print("Error: the batch benchmark needs NumPy")
+        exit(1)
+    print("%10s %10s %14s %14s %10s" % ("lanes", "ops", "scalar", "batch", "speedup"))
+    with tempfile.TemporaryDirectory() as tmp:
+        (_, program) = load_workload(tmp, "batch", size, "nested")
+        rng = random.Random(69)
+        for count in lane_counts:
+            seeds = [rng.randint(0, 1000) for _ in range(count)]
+            scalar_out = porth.SimOutput(capture=True)
+            (scalar, _) = timed(simulate_seeds_scalar, program, 0, seeds, scalar_out)
+            batch_out = porth.SimOutput(capture=True)
+            (batch, _) = timed(porth.simulate_program_batch, program, [0], [[seed] for seed in seeds], batch_out)
+            assert batch_out.getvalue() == scalar_out.getvalue(), "Batch output differs from the scalar runs"
+            print("%10d %10d %13.3fs %13.3fs %9.1fx" % (count, len(program), scalar, batch, scalar / batch))
+
+# Every generated program folded and simulated again, the output has to stay the same
+def bench_fold(sizes):
+    print("%10s %8s %10s %10s %10s %10s %10s" % ("program", "size", "ops", "fold", "folded", "sim", "sim folded"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in PROGRAM_KINDS:
+            for size in sizes:
+                (_, program) = load_workload(tmp, "%s_%d" % (kind, size), size, kind)
+                out = porth.SimOutput(capture=True)
+                (sim, _) = timed(porth.simulate_program, program, out)
+                (fold, (folded, _)) = timed(porth.fold_program, program)
+                porth.analyze_stack(folded)
+                folded_out = porth.SimOutput(capture=True)
+                (sim_folded, _) = timed(porth.simulate_program, folded, folded_out)
+                assert folded_out.getvalue() == out.getvalue(), "Folding changed the output of %s" % kind
+                print("%10s %8s %10d %9.3fs %10d %9.3fs %9.3fs" % (kind, format_size(size), len(program), fold, len(folded), sim, sim_folded))
+
+# The emitter before the templates: one write call per line straight into the file
+def compile_program_line_writes(program, asm_path):
+    ops = program.ops
+    args = program.args
+    templates = [template.splitlines(keepends=True) for template in porth.COMPILED_OP_TEMPLATES]
+    with open(asm_path, "w") as out:
+        for line in porth.COMPILED_PROLOGUE.splitlines(keepends=True):
+            out.write(line)
+        for ip in range(len(ops)):
+            op = ops[ip]
+            numbers = {porth.OP_PUSH: (args[ip], ), porth.OP_IF: (args[ip], ), porth.OP_ELSE: (args[ip], ip + 1), porth.OP_END: (ip, )}.get(op, ())
+            for line in templates[op]:
+                if "%d" in line:
+                    out.write(line % numbers[:line.count("%d")])
+                    numbers = numbers[line.count("%d"):]
+                else:
+                    out.write(line)
+        for line in (porth.COMPILED_EPILOGUE % (program.max_depth + porth.COMPILED_STACK_SLACK)).splitlines(keepends=True):
+            out.write(line)
+
+def bench_emit(sizes):
+    print("%8s %10s %12s %14s %10s %10s" % ("size", "ops", "asm lines", "line writes", "templates", "peephole"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            (_, program) = load_workload(tmp, "emit_%d" % size, size)
+            (lines, templates) = (os.path.join(tmp, "lines.asm"), os.path.join(tmp, "templates.asm"))
+            (line_writes, _) = timed(compile_program_line_writes, program, lines)
+            (templated, _) = timed(porth.compile_program, program, templates, False, False)
+            with open(lines, "rb") as a, open(templates, "rb") as b:
+                expected = a.read()
+                assert expected == b.read(), "Templates wrote different assembly"
+            (optimized, _) = timed(porth.compile_program, program, templates) # What com does by default
+            print("%8s %10d %12d %13.3fs %9.3fs %9.3fs" % (format_size(size), len(program), expected.count(b"\n"), line_writes, templated, optimized))
+
+# compile_program keyword arguments for every code generation mode bench com compares
+COMPILE_MODES = {
+    "stack": {"peephole": False},
+    "peephole": {},
+    "tos-cache": {"tos_cache": True, "peephole": False},
+}
+
+# Instructions in _start and how many of them push or pop, jumps and labels
+# included, the language has no loops so no instruction runs more than once
+def count_instructions(asm_path):
+    instructions = 0
+    stack_ops = 0
+    in_start = False
+    with open(asm_path) as f:
+        for line in f:
+            word = line.split(";")[0].split()
+            if line.startswith("_start:"):
+                in_start = True
+            elif line.startswith("segment .bss"):
+                in_start = False
+            elif in_start and word and not line[0].isalpha():
+                instructions += 1
+                stack_ops += word[0] in ("push", "pop")
+    return (instructions, stack_ops)
+
+def build_program(program, asm_path, mode):
+    porth.compile_program(program, asm_path, **COMPILE_MODES[mode])
+    return assemble_program(asm_path)
+
+def assemble_program(asm_path):
+    binary_path = os.path.splitext(asm_path)[0]
+    subprocess.run(["nasm", "-felf64", asm_path, "-o", binary_path + ".o"], check=True)
+    subprocess.run(["ld", binary_path + ".o", "-o", binary_path], check=True)
+    return binary_path
+
+def run_binary(binary_path, repeats):
+    best = None
+    for _ in range(repeats):
+        (seconds, result) = timed(lambda: subprocess.run([binary_path], stdout=subprocess.PIPE))
+        assert result.returncode == 0, "%s exited with %d" % (binary_path, result.returncode)
+        best = seconds if best is None else min(best, seconds)
+    return (best, result.stdout)
+
+# Compiled binaries of every mode in COMPILE_MODES, best of `repeats` runs,
+# needs nasm and ld like porth.py com
+def bench_com(sizes, repeats, modes=COMPILE_MODES):
+    print("%10s %8s %10s" % ("program", "size", "ops") + "".join(" %12s %10s %10s" % (mode, "push/pop", "run") for mode in modes))
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in PROGRAM_KINDS:
+            for size in sizes:
+                (_, program) = load_workload(tmp, "%s_%d" % (kind, size), size, kind)
+                row = "%10s %8s %10d" % (kind, format_size(size), len(program))
+                expected = None
+                for mode in modes:
+                    asm_path = os.path.join(tmp, "%s_%d_%s.asm" % (kind, size, mode))
+                    binary_path = build_program(program, asm_path, mode)
+                    (instructions, stack_ops) = count_instructions(asm_path)
+                    (seconds, output) = run_binary(binary_path, repeats)
+                    if expected is None:
+                        expected = output
+                    assert output == expected, "%s binary output differs" % mode
+                    row += " %12d %10d %9.4fs" % (instructions, stack_ops, seconds)
+                print(row)
+
+# The runtime before the output buffer: dump divides by 10 for every digit
+# and makes one write syscall per number
+UNBUFFERED_PROLOGUE = (
+    "BITS 64\n"
+    "segment .text\n"
+    "dump:\n"
+    "    mov  r9, -3689348814741910323\n"
+    "    sub  rsp, 40\n"
+    "    mov  BYTE [rsp+31], 10\n"
+    "    lea  rcx, [rsp+30]\n"
+    ".L2:\n"
+    "    mov  rax, rdi\n"
+    "    lea  r8, [rsp+32]\n"
+    "    mul  r9\n"
+    "    mov  rax, rdi\n"
+    "    sub  r8, rcx\n"
+    "    shr  rdx, 3\n"
+    "    lea  rsi, [rdx+rdx*4]\n"
+    "    add  rsi, rsi\n"
+    "    sub  rax, rsi\n"
+    "    add  eax, 48\n"
+    "    mov  BYTE [rcx], al\n"
+    "    mov  rax, rdi\n"
+    "    mov  rdi, rdx\n"
+    "    mov  rdx, rcx\n"
+    "    sub  rcx, 1\n"
+    "    cmp  rax, 9\n"
+    "    ja   .L2\n"
+    "    lea  rax, [rsp+32]\n"
+    "    mov  edi, 1\n"
+    "    sub  rdx, rax\n"
+    "    xor  eax, eax\n"
+    "    lea  rsi, [rsp+32+rdx]\n"
+    "    mov  rdx, r8\n"
+    "    mov  rax, 1\n"
+    "    syscall\n"
+    "    add  rsp, 40\n"
+    "    ret\n"
+    "global _start\n"
+    "_start:\n"
+    "    mov  rsp, porth_stack_end\n"
+)
+UNBUFFERED_EPILOGUE = (
+    "    mov  rax, 60\n"
+    "    mov  rdi, 0\n"
+    "    syscall\n"
+    "segment .bss\n"
+    "porth_stack: resq %d\n"
+    "porth_stack_end:\n"
+)
+
+# Swaps the runtime around the ops compile_program wrote for the unbuffered one
+def use_unbuffered_runtime(program, asm_path):
+    with open(asm_path) as f:
+        text = f.read()
+    epilogue = porth.COMPILED_EPILOGUE % (program.max_depth + porth.COMPILED_STACK_SLACK)
+    assert text.startswith(porth.COMPILED_PROLOGUE) and text.endswith(epilogue), "%s has no runtime to swap" % asm_path
+    ops = text[len(porth.COMPILED_PROLOGUE):len(text) - len(epilogue)]
+    with open(asm_path, "w") as f:
+        f.write(UNBUFFERED_PROLOGUE + ops + UNBUFFERED_EPILOGUE % (program.max_depth + porth.COMPILED_STACK_SLACK))
+
+# Write syscalls of one run, read from /proc before the exited binary is reaped
+def count_write_syscalls(binary_path):
+    process = subprocess.Popen([binary_path], stdout=subprocess.DEVNULL)
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    with open("/proc/%d/io" % process.pid) as f:
+        writes = int(dict(line.split(": ") for line in f.read().splitlines())["syscw"])
+    process.wait()
+    return writes
+
+# Dump heavy binaries with the unbuffered runtime and with the buffered one,
+# needs nasm and ld like porth.py com and /proc for the syscall counts
+def bench_runtime(counts, repeats):
+    print("%10s %10s %12s %10s %12s %10s" % ("dumps", "output", "writes(old)", "run(old)", "writes(new)", "run(new)"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in counts:
+            file_path = os.path.join(tmp, "dump_%d.porth" % count)
+            rng = random.Random(69)
+            with open(file_path, "w") as f:
+                for _ in range(count):
+                    f.write("%d .\n" % rng.randint(0, 10 ** rng.randint(1, 18)))
+            program = porth.load_program_from_file(file_path)
+            porth.analyze_stack(program)
+            row = "%10d" % count
+            expected = None
+            for runtime in ("old", "new"):
+                asm_path = os.path.join(tmp, "dump_%d_%s.asm" % (count, runtime))
+                porth.compile_program(program, asm_path)
+                if runtime == "old":
+                    use_unbuffered_runtime(program, asm_path)
+                binary_path = assemble_program(asm_path)
+                (seconds, output) = run_binary(binary_path, repeats)
+                if expected is None:
+                    expected = output
+                    row += " %10s" % format_size(len(output))
+                assert output == expected, "%s runtime output differs" % runtime
+                row += " %12d %9.4fs" % (count_write_syscalls(binary_path), seconds)
+            print(row)
+
+# porth.py com wall time with each backend in COM_BACKENDS, best of `repeats`,
+# then checks the binaries print the same, needs nasm and ld for the nasm backend
+def bench_backends(sizes, repeats):
+    porth_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "porth.py")
+    print("%8s %10s" % ("size", "ops") + "".join(" %12s" % ("com(%s)" % backend) for backend in porth.COM_BACKENDS))
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            (file_path, program) = load_workload(tmp, "program_%d" % size, size)
+            row = "%8s %10d" % (format_size(size), len(program))
+            expected = None
+            for backend in porth.COM_BACKENDS:
+                build_dir = os.path.join(tmp, backend)
+                os.makedirs(build_dir, exist_ok=True)
+                com = lambda: subprocess.run([sys.executable, porth_path, "com", "--no-cache", "--backend=%s" % backend, file_path], cwd=build_dir, stdout=subprocess.DEVNULL, check=True)
+                seconds = min(timed(com)[0] for _ in range(repeats))
+                (_, output) = run_binary(os.path.join(build_dir, "program_%d" % size), 1)
+                if expected is None:
+                    expected = output
+                assert output == expected, "%s backend binary output differs" % backend
+                row += " %11.3fs" % seconds
+            print(row)
+
+# The nasm and the c backend on every kind of program, time to build and best
+# of `repeats` runs, both have to print what simulate_program prints, as the
+# unsigned numbers the compiled dump prints. Needs nasm, ld and cc.
+def bench_c(sizes, repeats):
+    print("%10s %8s %10s %12s %10s %12s %10s" % ("program", "size", "ops", "build(nasm)", "run(nasm)", "build(c)", "run(c)"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in PROGRAM_KINDS:
+            for size in sizes:
+                (_, program) = load_workload(tmp, "%s_%d" % (kind, size), size, kind)
+                out = porth.SimOutput(capture=True)
+                porth.simulate_program(program, out)
+                expected = b"".join(b"%d\n" % (int(value) & 0xFFFFFFFFFFFFFFFF) for value in out.getvalue().split())
+                row = "%10s %8s %10d" % (kind, format_size(size), len(program))
+                for backend in ("nasm", "c"):
+                    base_path = os.path.join(tmp, "%s_%d_%s" % (kind, size, backend))
+                    def build():
+                        if backend == "c":
+                            porth.compile_program_c(program, base_path + ".c")
+                        else:
+                            porth.compile_program(program, base_path + ".asm")
+                        for cmd in porth.build_commands(base_path, backend):
+                            subprocess.run(cmd, check=True)
+                    (build_time, _) = timed(build)
+                    (seconds, output) = run_binary(base_path, repeats)
+                    assert output == expected, "%s binary prints something else than simulate_program" % backend
+                    row += " %11.3fs %9.4fs" % (build_time, seconds)
+                print(row)
+
+# Loading the way it was done before the streaming pipeline: all tokens, then all ops
+def load_program_materialized(file_path):
+    tokens = list(porth.lex_file(file_path))
+    return porth.crossreference_blocks([porth.parse_token_as_op(token) for token in tokens])
+
+def traced(fun, *args):
+    tracemalloc.start()
+    result = fun(*args)
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (current, peak, result)
+
+def bench_load_memory(sizes):
+    print("%8s %10s %14s %14s %14s %8s" % ("size", "ops", "program", "peak(lists)", "peak(stream)", "ratio"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            file_path = write_workload(tmp, "program_%d" % size, size)
+            (_, old_peak, old_program) = traced(load_program_materialized, file_path)
+            del old_program
+            (retained, new_peak, new_program) = traced(porth.load_program_from_file, file_path)
+            # Peak may only exceed the final program by the file chunk being lexed
+            # and the few tokens in flight, not by a full list of tokens or ops.
+            overhead = new_peak - retained
+            assert overhead < 8 * porth.LEX_CHUNK_SIZE + retained // 4, "streaming load peaked at %d bytes for a %d byte program" % (new_peak, retained)
+            print("%8s %10d %13dK %13dK %13dK %7.2fx" % (format_size(size), len(new_program), retained >> 10, old_peak >> 10, new_peak >> 10, new_peak / retained))
+            del new_program
+
+def bench_token_memory(counts):
+    print("%10s %14s %14s %10s %10s" % ("tokens", "tuples", "TokenStore", "B/token", "saving"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in counts:
+            file_path = os.path.join(tmp, "tokens_%d.porth" % count)
+            generate_tokens_file(file_path, count)
+            (tuples_size, _, tokens) = traced(lambda p: list(porth.lex_file(p)), file_path)
+            (store_size, _, store) = traced(porth.lex_file_to_store, file_path)
+            assert len(store) == len(tokens) == count
+            assert all(store[i] == tokens[i] for i in range(0, count, max(1, count // 1000)))
+            print("%10d %13dK %13dK %10.1f %9.1fx" % (count, tuples_size >> 10, store_size >> 10, store_size / count, tuples_size / store_size))
+            del tokens, store
+
+def bench_cache(sizes):
+    porth_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "porth.py")
+    print("%8s %10s %12s %12s %12s %12s" % ("size", "ops", "load(cold)", "load(warm)", "sim(cold)", "sim(warm)"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            file_path = write_workload(tmp, "program_%d" % size, size)
+            cache_path = porth.porthc_path(file_path)
+            (cold_load, program) = timed(porth.load_program, file_path)
+            (warm_load, _) = timed(porth.load_program, file_path)
+            os.remove(cache_path)
+            sim = lambda: subprocess.run([sys.executable, porth_path, "sim", file_path], stdout=subprocess.DEVNULL, check=True)
+            (cold_sim, _) = timed(sim)
+            (warm_sim, _) = timed(sim)
+            print("%8s %10d %11.3fs %11.3fs %11.3fs %11.3fs" % (format_size(size), len(program), cold_load, warm_load, cold_sim, warm_sim))
+
+# Sanity checks that the build cache hands back the same binary and drops the
+# least recently used entries first
+def check_build_cache(file_path, build_dir, cache_dir):
+    porth_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "porth.py")
+    binary_path = os.path.join(build_dir, os.path.splitext(os.path.basename(file_path))[0])
+    com = lambda *flags: subprocess.run([sys.executable, porth_path, "com", *flags, file_path], cwd=build_dir, stdout=subprocess.PIPE, check=True).stdout
+    assert b"[CMD] nasm" in com("--no-cache"), "--no-cache used the build cache"
+    (_, expected) = run_binary(binary_path, 1)
+    assert not os.listdir(cache_dir), "--no-cache wrote to the build cache"
+    assert b"[CMD] nasm" in com() and len(os.listdir(cache_dir)) == 1
+    os.remove(binary_path)
+    assert b"build cache" in com(), "unchanged program was built again"
+    assert run_binary(binary_path, 1)[1] == expected, "cached binary prints something else"
+    with open(file_path, "a") as f:
+        f.write("1 .\n")
+    assert b"[CMD] nasm" in com() and len(os.listdir(cache_dir)) == 2, "changed program reused a stale binary"
+    (oldest, newest) = sorted(os.listdir(cache_dir), key=lambda name: os.path.getmtime(os.path.join(cache_dir, name)))
+    newest_size = sum(os.path.getsize(os.path.join(cache_dir, newest, name)) for name in os.listdir(os.path.join(cache_dir, newest)))
+    porth.evict_build_cache(cache_dir, newest_size)
+    assert os.listdir(cache_dir) == [newest], "eviction kept %s over the most recently used entry" % oldest
+    porth.evict_build_cache(cache_dir, 0)
+    assert os.listdir(cache_dir) == [], "eviction left entries over the size bound"
+
+# porth.py com without the build cache, with an empty one and with the
+# binary already in it, needs nasm and ld like porth.py com
+def bench_build_cache(sizes, repeats):
+    porth_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "porth.py")
+    print("%8s %10s %15s %12s %12s" % ("size", "ops", "com(--no-cache)", "com(cold)", "com(warm)"))
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_dir = os.path.join(tmp, "cache")
+        os.makedirs(cache_dir)
+        saved_cache = os.environ.get("PORTH_BUILD_CACHE")
+        os.environ["PORTH_BUILD_CACHE"] = cache_dir
+        try:
+            check_build_cache(write_workload(tmp, "check", 4096), tmp, cache_dir)
+            for size in sizes:
+                (file_path, program) = load_workload(tmp, "program_%d" % size, size)
+                com = lambda *flags: subprocess.run([sys.executable, porth_path, "com", *flags, file_path], cwd=tmp, stdout=subprocess.DEVNULL, check=True)
+                uncached = min(timed(com, "--no-cache")[0] for _ in range(repeats))
+                cold = []
+                for _ in range(repeats):
+                    porth.evict_build_cache(cache_dir, 0)
+                    cold.append(timed(com)[0])
+                warm = min(timed(com)[0] for _ in range(repeats))
+                print("%8s %10d %14.3fs %11.3fs %11.3fs" % (format_size(size), len(program), uncached, min(cold), warm))
+        finally:
+            if saved_cache is None:
+                del os.environ["PORTH_BUILD_CACHE"]
+            else:
+                os.environ["PORTH_BUILD_CACHE"] = saved_cache
+
+# A corpus of `count` small programs compiled one porth.py com per file, the
+# way it was done before com took many files, then with one com for all of
+# them at -j 1 and at the number of CPUs, needs nasm and ld like porth.py com
+def bench_corpus(count, size, repeats):
+    porth_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "porth.py")
+    jobs = os.cpu_count() or 1
+    print("%8s %8s %14s %12s %12s" % ("programs", "size", "com per file", "com -j 1", "com -j %d" % jobs))
+    with tempfile.TemporaryDirectory() as tmp:
+        file_paths = [write_workload(tmp, "program_%d" % n, size, seed=n) for n in range(count)]
+        out_dir = os.path.join(tmp, "out")
+        com = lambda *args: subprocess.run([sys.executable, porth_path, "com", "--no-cache", *args], cwd=tmp, stdout=subprocess.DEVNULL, check=True)
+        per_file = min(timed(lambda: [com("-o", out_dir, file_path) for file_path in file_paths])[0] for _ in range(repeats))
+        serial = min(timed(com, "-o", out_dir, "-j", "1", *file_paths)[0] for _ in range(repeats))
+        parallel = min(timed(com, "-o", out_dir, "-j", str(jobs), *file_paths)[0] for _ in range(repeats))
+        for n in range(count):
+            assert os.access(os.path.join(out_dir, "program_%d" % n), os.X_OK), "program_%d was not built" % n
+        print("%8d %8s %13.3fs %11.3fs %11.3fs" % (count, format_size(size), per_file, serial, parallel))
+
+# Workloads of bench suite, the parameters of generate_workload_file
+SUITE_WORKLOADS = {
+    "flat": {"size": 1 << 20, "depth": 0, "branches": 0.0, "trips": 1, "dump_every": 8},
+    "branchy": {"size": 1 << 20, "depth": 4, "branches": 0.5, "trips": 1, "dump_every": 8},
+    "deep": {"size": 1 << 20, "depth": 64, "branches": 0.95, "trips": 1, "dump_every": 8},
+    "looped": {"size": 1 << 20, "depth": 2, "branches": 0.3, "trips": 100, "dump_every": 8},
+    "dumpy": {"size": 1 << 20, "depth": 2, "branches": 0.3, "trips": 1, "dump_every": 1},
+}
+SUITE_PHASES = ("lex", "parse", "crossreference", "analyze", "simulate", "compile")
+SUITE_RESULTS_VERSION = 1
+# Phases this fast are timer noise, they are compared but never count as a regression
+SUITE_MIN_SECONDS = 0.01
+
+# Every phase of loading, simulating and compiling one after the other, in
+# seconds, compile only writes the assembly and doesn't run nasm
+def time_phases(file_path, asm_path):
+    timings = {}
+    (timings["lex"], tokens) = timed(lambda: list(porth.lex_file(file_path)))
+    (timings["parse"], ops) = timed(lambda: [porth.parse_token_as_op(token) for token in tokens])
+    (timings["crossreference"], program) = timed(porth.crossreference_blocks, ops)
+    (timings["analyze"], _) = timed(porth.analyze_stack, program)
+    (timings["simulate"], _) = timed(porth.simulate_program, program, porth.SimOutput(capture=True))
+    (timings["compile"], _) = timed(porth.compile_program, program, asm_path)
+    return (len(program), timings)
+
+def run_suite(workloads, repeats):
+    results = {"version": SUITE_RESULTS_VERSION, "python": platform.python_version(), "repeats": repeats, "workloads": {}}
+    print("%10s %10s" % ("workload", "ops") + "".join(" %14s" % phase for phase in SUITE_PHASES))
+    with tempfile.TemporaryDirectory() as tmp:
+        for (name, params) in workloads.items():
+            file_path = os.path.join(tmp, "%s.porth" % name)
+            generate_workload_file(file_path, **params)
+            best = {}
+            for _ in range(repeats):
+                (ops, timings) = time_phases(file_path, os.path.join(tmp, "%s.asm" % name))
+                for phase in SUITE_PHASES:
+                    best[phase] = min(best.get(phase, timings[phase]), timings[phase])
+            results["workloads"][name] = {"params": params, "ops": ops, "phases": best}
+            print("%10s %10d" % (name, ops) + "".join(" %13.3fs" % best[phase] for phase in SUITE_PHASES))
+    return results
+
+# Gives back how many phases got slower than the baseline by more than `threshold`
+def compare_suite(results, baseline, threshold):
+    regressions = 0
+    print("%10s %14s %12s %12s %8s" % ("workload", "phase", "baseline", "current", "change"))
+    for (name, current) in results["workloads"].items():
+        before = baseline["workloads"].get(name)
+        if before is None or before["params"] != current["params"]:
+            print("%10s %14s   not in the baseline with the same parameters" % (name, ""))
+            continue
+        for phase in SUITE_PHASES:
+            (old, new) = (before["phases"][phase], current["phases"][phase])
+            change = new / old - 1 if old > 0 else 0.0
+            regressed = change > threshold and new >= SUITE_MIN_SECONDS
+            regressions += regressed
+            print("%10s %14s %11.3fs %11.3fs %+7.1f%%%s" % (name, phase, old, new, change * 100, "  REGRESSION" if regressed else ""))
+    return regressions
+
+# bench suite [name=value...] [--repeats=N] [--save=file] [--baseline=file] [--threshold=percent],
+# name=value sets a parameter of generate_workload_file for every workload
+def bench_suite(argv):
+    workloads = {name: dict(params) for (name, params) in SUITE_WORKLOADS.items()}
+    repeats = 3
+    save_path = None
+    baseline_path = None
+    threshold = 10.0
+    for arg in argv:
+        (key, _, value) = arg.partition("=")
+        if key == "--repeats":
+            repeats = int(value)
+        elif key == "--save":
+            save_path = value
+        elif key == "--baseline":
+            baseline_path = value
+        elif key == "--threshold":
+            threshold = float(value)
+        elif key == "size":
+            for params in workloads.values():
+                params["size"] = parse_size(value)
+        elif key in ("depth", "trips", "dump_every"):
+            for params in workloads.values():
+                params[key] = int(value)
+        elif key == "branches":
+            for params in workloads.values():
+                params[key] = float(value)
+        else:
+            print("Error: Unknown suite argument %s" % arg)
+            exit(1)
+    baseline = None
+    if baseline_path is not None:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline.get("version") != SUITE_RESULTS_VERSION:
+            print("Error: %s is not a baseline saved by bench suite --save" % baseline_path)
+            exit(1)
+    results = run_suite(workloads, repeats)
+    if save_path is not None:
+        with open(save_path, "w") as f:
+            json.dump(results, f, indent=2)
+        print("[INFO] Saved results to %s" % save_path)
+    if baseline is not None:
+        regressions = compare_suite(results, baseline, threshold / 100)
+        print("[INFO] %d phase(s) more than %g%% slower than %s" % (regressions, threshold, baseline_path))
+        if regressions:
+            exit(1)
+
+# Quick checks
+# Small programs, run in a few seconds and without nasm, every check raises
+# AssertionError when it finds something wrong. Literals that don't fit in 32
+# bits, long runs of pushes and chains of comparisons are the edge cases of
+# the code generators, the workloads cover the usual mix with and without ifs.
+CHECK_SOURCES = {
+    "wide": "8589934592 1 + .\n-2147483649 1 - .\n2147483647 1 + .\n2147483648 dup = .\n9223372036854775807 .\n",
+    "pushes": " ".join(str(n) for n in range(1, 30)) + " +" * 28 + " .\n",
+    "compares": "1 2 3 4 5 6 7 8 9 10 11 12 = = = = = = = = = = = .\n1 2 > 2 1 > = .\n",
+}
+CHECK_WORKLOADS = {
+    "flat": {"size": 4096, "depth": 0, "branches": 0.0},
+    "branchy": {"size": 4096, "depth": 4, "branches": 0.5},
+    "deep": {"size": 4096, "depth": 16, "branches": 0.9, "dump_every": 1},
+}
+
+# Writes every program of CHECK_SOURCES and CHECK_WORKLOADS into tmp, gives back their paths
+def write_check_programs(tmp):
+    file_paths = []
+    for (name, source) in CHECK_SOURCES.items():
+        file_paths.append(os.path.join(tmp, "%s.porth" % name))
+        with open(file_paths[-1], "w") as f:
+            f.write(source)
+    for (name, params) in CHECK_WORKLOADS.items():
+        file_paths.append(os.path.join(tmp, "%s.porth" % name))
+        generate_workload_file(file_paths[-1], **params)
+    return file_paths
+
+# compile_ops_peephole has to write the same assembly and count the same rules
+# as peephole_optimize over what compile_ops writes, and the binaries with and
+# without the peephole pass have to print the same
+def check_peephole(tmp):
+    for file_path in write_check_programs(tmp):
+        program = porth.load_program_from_file(file_path)
+        porth.analyze_stack(program)
+        out = porth.AsmBuffer()
+        out.write(porth.COMPILED_PROLOGUE)
+        porth.compile_ops(out, program)
+        out.write(porth.COMPILED_EPILOGUE % (program.max_depth + porth.COMPILED_STACK_SLACK))
+        (lines, expected_fired) = porth.peephole_optimize(out.records())
+        (templated, fired) = porth.generate_assembly(program)
+        assert "".join(templated.texts) == "".join(porth.AsmBuffer(lines).texts), "peephole templates wrote different assembly for %s" % file_path
+        assert fired == expected_fired, "peephole templates counted %s, peephole_optimize %s for %s" % (fired, expected_fired, file_path)
+        outputs = []
+        for peephole in (True, False):
+            binary_path = os.path.splitext(file_path)[0] + ("" if peephole else "_no_peephole")
+            porth.assemble_program(program, binary_path, peephole=peephole)
+            outputs.append(subprocess.run([binary_path], stdout=subprocess.PIPE, check=True).stdout)
+        assert outputs[0] == outputs[1], "%s prints something else with the peephole pass" % file_path
+
+# A stale .porthc is never used: not after the source changes, not after
+# PORTHC_VERSION changes and not when the file is cut short
+def check_program_cache(tmp):
+    file_path = write_check_programs(tmp)[-1]
+    cache_path = porth.porthc_path(file_path)
+    expected = porth.load_program_from_file(file_path)
+    assert porth.load_program(file_path) == expected and os.path.exists(cache_path)
+    assert porth.load_program(file_path) == expected, "warm load differs from parsing"
+    with open(file_path, "a") as f:
+        f.write("1 if 2 . else 3 . end\n")
+    assert porth.load_program(file_path) == porth.load_program_from_file(file_path), "source change not noticed"
+    saved_version = porth.PORTHC_VERSION
+    porth.PORTHC_VERSION += 1
+    try:
+        with open(file_path, "rb") as f:
+            key = porth.porthc_key(f.read())
+        assert porth.load_program_cache(cache_path, key, file_path) is None, "compiler change not noticed"
+    finally:
+        porth.PORTHC_VERSION = saved_version
+    with open(cache_path, "r+b") as f:
+        f.truncate(os.path.getsize(cache_path) - 8)
+    assert porth.load_program(file_path) == porth.load_program_from_file(file_path), "truncated cache was used"
+
+# Every program of examples/ that loads, some are kept from later stages of the
+# language, like loop.porth, and fail in this one
+def load_examples():
+    examples_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+    examples = {}
+    for name in sorted(os.listdir(examples_dir)):
+        if name.endswith(".porth"):
+            with contextlib.redirect_stdout(io.StringIO()):
+                try:
+                    examples[name] = porth.load_program_from_file(os.path.join(examples_dir, name))
+                except SystemExit:
+                    pass
+    return examples
+
+# fold_program can't change what a program prints, not in sim and not compiled
+def check_fold(tmp):
+    examples = load_examples()
+    programs = [(file_path, porth.load_program_from_file(file_path)) for file_path in write_check_programs(tmp)]
+    for (file_path, program) in programs + list(examples.items()):
+        porth.analyze_stack(program)
+        (folded, _) = porth.fold_program(program)
+        porth.analyze_stack(folded)
+        outputs = []
+        for (n, candidate) in enumerate((program, folded)):
+            out = porth.SimOutput(capture=True)
+            porth.simulate_program(candidate, out)
+            binary_path = os.path.join(tmp, "fold_%d" % n)
+            porth.assemble_program(candidate, binary_path)
+            compiled = subprocess.run([binary_path], stdout=subprocess.PIPE, check=True).stdout
+            outputs.append((out.getvalue(), compiled))
+        assert outputs[0][0] == outputs[1][0], "Folding changed what sim prints for %s" % file_path
+        assert outputs[0][1] == outputs[1][1], "Folding changed what the binary prints for %s" % file_path
+    (folded, _) = porth.fold_program(examples["test_nested.porth"])
+    assert porth.OP_IF not in folded.ops, "Constant conditions of test_nested.porth were left for runtime"
+
+# Every backend has to print what simulate_program prints, as the unsigned
+# numbers a compiled dump prints. Programs with literals over 32 bits are left
+# out, the assembly backends don't push those as they are.
+def check_backends(tmp):
+    backends = [backend for backend in ("nasm", "c") if all(shutil.which(cmd[0]) for cmd in porth.BUILD_COMMANDS[backend])]
+    if "nasm" not in backends:
+        print("[INFO] nasm or ld not found, the nasm backend is not checked")
+    programs = [(file_path, porth.load_program_from_file(file_path)) for file_path in write_check_programs(tmp)]
+    for (file_path, program) in programs + list(load_examples().items()):
+        if any(op == porth.OP_PUSH and not porth.fits_dword(arg) for (op, arg) in zip(program.ops, program.args)):
+            continue
+        porth.analyze_stack(program)
+        out = porth.SimOutput(capture=True)
+        porth.simulate_program(program, out)
+        expected = b"".join(b"%d\n" % (int(value) & 0xFFFFFFFFFFFFFFFF) for value in out.getvalue().split())
+        base_path = os.path.join(tmp, "backends")
+        outputs = {}
+        for tos_cache in (False, True):
+            porth.assemble_program(program, base_path, tos_cache)
+            outputs["elf", tos_cache] = subprocess.run([base_path], stdout=subprocess.PIPE, check=True).stdout
+            if "nasm" in backends:
+                porth.compile_program(program, base_path + ".asm", tos_cache)
+                for cmd in porth.build_commands(base_path, "nasm"):
+                    subprocess.run(cmd, check=True)
+                outputs["nasm", tos_cache] = subprocess.run([base_path], stdout=subprocess.PIPE, check=True).stdout
+        if "c" in backends:
+            porth.compile_program_c(program, base_path + ".c")
+            for cmd in porth.build_commands(base_path, "c"):
+                subprocess.run(cmd, check=True)
+            outputs["c", False] = subprocess.run([base_path], stdout=subprocess.PIPE, check=True).stdout
+        for ((backend, tos_cache), output) in outputs.items():
+            assert output == expected, "The %s binary%s of %s prints something else than sim" % (backend, " with tos cache" if tos_cache else "", file_path)
+
+CHECKS = {
+    "peephole": check_peephole,
+    "cache": check_program_cache,
+    "fold": check_fold,
+    "backends": check_backends,
+}
+
+def run_checks(names):
+    for name in names:
+        if name not in CHECKS:
+            print("Error: Unknown check %s, expected one of %s" % (name, ", ".join(CHECKS)))
+            exit(1)
+    for name in names:
+        with tempfile.TemporaryDirectory() as tmp:
+            (seconds, _) = timed(CHECKS[name], tmp)
+        print("[OK] %s in %.3fs" % (name, seconds))
+
+def usage(bench_name):
+    print("Usage: %s <benchmark> [args]" % bench_name)
+    print("     lex [sizes...]    Compare lex_file against the old lex_line scanner (default: 1K 1M 10M 100M)")
+    print("     memory [sizes...] Peak memory of load_program_from_file against materialized lists (default: 1M 10M 50M)")
+    print("     tokens [counts...] Memory of a token list against a TokenStore (default: 1M tokens)")
+    print("     parse [count]     Parse literal-heavy and keyword-heavy programs (default: 1M tokens)")
+    print("     cache [sizes...]  Time cold and warm loads with the .porthc cache (default: 100K 1M 10M)")
+    print("     program [sizes...] Memory and simulate_program throughput of Program against op tuples (default: 1M 10M)")
+    print("     engines [sizes...] Instructions per second of every simulator engine, each run 10 times (default: 100K 1M)")
+    print("     jit [sizes...]    Every engine on arithmetic, block and nested programs, each run 10 times (default: 100K 1M)")
+    print("     fuse [sizes...]   Ladder and closure engines with and without fused ops, each run 10 times (default: 1M)")
+    print("     dump [counts...]  Dump heavy program through print and through SimOutput (default: 1M)")
+    print("     batch [lanes...]  Scalar runs per seed against one sim --batch run of a 10K nested program (default: 10 100 1K 10K)")
+    print("     trace [sizes...]  Closure engine with and without sim --trace=16/1K/64K (default: 100K 1M)")
+    print("     fold [sizes...]   Ops and simulation time before and after fold_program, checks the output is the same (default: 100K 1M)")
+    print("     emit [sizes...]   Time to write the assembly line by line, from templates and from templates with peephole (default: 100K 1M 10M)")
+    print("     com [sizes...]    Instructions and runtime of compiled programs for every code generation mode (default: 100K 1M)")
+    print("     runtime [counts...] Write syscalls and runtime of dump heavy binaries before and after the output buffer (default: 10K 100K 1M)")
+    print("     backends [sizes...] porth.py com time with every backend, checks the binaries print the same (default: 1K 100K 1M)")
+    print("     build [sizes...]  Check the com build cache, then time com without it, cold and warm (default: 1K 100K 1M)")
+    print("     corpus [count]    com of many 2K programs one process per file and in one process (default: 300)")
+    print("     c [sizes...]      Build time and runtime of the nasm and c backends, checks both against sim (default: 10K 100K)")
+    print("     suite [options]   Time every phase on generated workloads, save them as JSON and compare to a baseline")
+    print("                       name=value sets size, depth, branches, trips or dump_every of every workload")
+    print("                       --repeats=<n> --save=<file.json> --baseline=<file.json> --threshold=<percent> (default: 3, 10)")
+    print("     check [names...]  Quick correctness checks on small programs, no nasm needed (default: all of %s)" % " ".join(CHECKS))
+    print("     help              Print this help to stdout and exit with 0 code")
+
+if __name__ == '__main__':
+    bench_name, *argv = sys.argv
+    if len(argv) < 1:
+        print("Error: No benchmark provided.")
+        usage(bench_name)
+        exit(1)
+    benchmark, *argv = argv
+
+    if benchmark == "lex":
+        sizes = [parse_size(arg) for arg in argv] or [parse_size(s) for s in ("1K", "1M", "10M", "100M")]
+        bench_lex(sizes)
+    elif benchmark == "memory":
+        sizes = [parse_size(arg) for arg in argv] or [parse_size(s) for s in ("1M", "10M", "50M")]
+        bench_load_memory(sizes)
+    elif benchmark == "tokens":
+        counts = [parse_size(arg) for arg in argv] or [1000000]
+        bench_token_memory(counts)
+    elif benchmark == "parse":
+        bench_parse(parse_size(argv[0]) if argv else 1000000)
+    elif benchmark == "cache":
+        sizes = [parse_size(arg) for arg in argv] or [parse_size(s) for s in ("100K", "1M", "10M")]
+        bench_cache(sizes)
+    elif benchmark == "program":
+        sizes = [parse_size(arg) for arg in argv] or [parse_size(s) for s in ("1M", "10M")]
+        bench_program(sizes)
+    elif benchmark == "engines":
+        sizes = [parse_size(arg) for arg in argv] or [parse_size(s) for s in ("100K", "1M")]
+        bench_engines(sizes, 10)
+    elif benchmark == "jit":
+        sizes = [parse_size(arg) for arg in argv] or [parse_size(s) for s in ("100K", "1M")]
+        bench_engines(sizes, 10, PROGRAM_KINDS)
+    elif benchmark == "fuse":
+        sizes = [parse_size(arg) for arg in argv] or [parse_size("1M")]
+        bench_fuse(sizes, 10)
+    elif benchmark == "dump":
+        counts = [parse_size(arg) for arg in argv] or [1000000]
+        bench_dump(counts)
+    elif benchmark == "batch":
+        lane_counts = [parse_size(arg) for arg in argv] or [parse_size(s) for s in ("10", "100", "1K", "10K")]
+        bench_batch(lane_counts, parse_size("10K"))
+    elif benchmark == "trace":
+        sizes = [parse_size(arg) for arg in argv] or [parse_size(s) for s in ("100K", "1M")]
+        bench_trace(sizes, [16, parse_size("1K"), parse_size("64K")])
+    elif benchmark == "fold":
+        sizes = [parse_size(arg) for arg in argv] or [parse_size(s) for s in ("100K", "1M")]
+        bench_fold(sizes)
+    elif benchmark == "emit":
+        sizes = [parse_size(arg) for arg in argv] or [parse_size(s) for s in ("100K", "1M", "10M")]
+        bench_emit(sizes)
+    elif benchmark == "com":
+        sizes = [parse_size(arg) for arg in argv] or [parse_size(s) for s in ("100K", "1M")]
+        bench_com(sizes, 20)
+    elif benchmark == "runtime":
+        counts = [parse_size(arg) for arg in argv] or [10000, 100000, 1000000]
+        bench_runtime(counts, 10)
+    elif benchmark == "backends":
+        sizes = [parse_size(arg) for arg in argv] or [parse_size(s) for s in ("1K", "100K", "1M")]
+        bench_backends(sizes, 5)
+    elif benchmark == "build":
+        sizes = [parse_size(arg) for arg in argv] or [parse_size(s) for s in ("1K", "100K", "1M")]
+        bench_build_cache(sizes, 3)
+    elif benchmark == "corpus":
+        count = int(argv[0]) if argv else 300
+        bench_corpus(count, 2048, 3)
+    elif benchmark == "c":
+        sizes = [parse_size(arg) for arg in argv] or [parse_size(s) for s in ("10K", "100K")]
+        bench_c(sizes, 20)
+    elif benchmark == "suite":
+        bench_suite(argv)
+    elif benchmark == "check":
+        run_checks(argv or list(CHECKS))
+    elif benchmark == "help":
+        usage(bench_name)
+        exit(0)
+    else:
+        print("Error: Unknown benchmark %s" % benchmark)
+        usage(bench_name)
+        exit(1)
@@ -3,6 +3,21 @@
 import sys
 import subprocess
 import shlex
+import re
+import os
+import hashlib
+import gc
+import io
+import contextlib
+import shutil
+import signal
+import struct
+import tempfile
+import time
+import traceback
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
 from os import path
 
 iota_counter = 0
@@ -31,6 +46,21 @@ OP_DUP = iota()
 OP_GT = iota() # Greater sign
 COUNT_OPS = iota()
 
+OP_NAMES = ["push", "plus", "minus", "equal", "dump", "if", "end", "else", "dup", "gt"]
+assert len(OP_NAMES) == COUNT_OPS, "Every op needs a name in OP_NAMES"
+
+# Fused ops, only made by fuse_program and only understood by the simulator.
+# Each one does the work of the whole sequence in its comment.
+OP_PUSH_PLUS = iota()      # push N +
+OP_PUSH_MINUS = iota()     # push N -
+OP_DUP_PUSH_GT = iota()    # dup push N >
+OP_DUP_PUSH_GT_IF = iota() # dup push N > if, args is an index into consts for (N, jump target)
+OP_DUP_DUMP = iota()       # dup .
+COUNT_FUSED_OPS = iota()
+
+FUSED_OP_NAMES = ["push+", "push-", "dup push>", "dup push> if", "dup dump"]
+assert len(FUSED_OP_NAMES) == COUNT_FUSED_OPS - COUNT_OPS - 1, "Every fused op needs a name in FUSED_OP_NAMES"
+
 # TODO:
 # OP_LT
 # OP_DO
@@ -67,261 +97,2545 @@ def dup():
 def gt():
     return (OP_GT, )
 
+# Program container, two int64 columns instead of a list of tuples.
+# ops holds the opcode, args the value of a push or the jump target of an
+# if/else, -1 where there is none (or the block is not crossreferenced yet).
+# file_ids/rows/cols remember where every op came from for error reporting.
+class Program:
+    def __init__(self):
+        self.ops = array("q")
+        self.args = array("q")
+        self.files = []
+        self.file_index = {}
+        self.file_ids = array("i")
+        self.rows = array("i")
+        self.cols = array("i")
+        self.consts = [] # Operands that don't fit in args, only used by fused ops
+        self.max_depth = None # Set by analyze_stack
+
+    # Throws OverflowError for push values that don't fit in 64 bits
+    def append(self, op, token=None):
+        self.args.append(op[1] if len(op) >= 2 else -1)
+        self.ops.append(op[0])
+        (file_path, row, col, _) = token if token is not None else ("", -1, -1, None)
+        file_id = self.file_index.get(file_path)
+        if file_id is None:
+            file_id = self.file_index[file_path] = len(self.files)
+            self.files.append(file_path)
+        self.file_ids.append(file_id)
+        self.rows.append(row)
+        self.cols.append(col)
+
+    def __len__(self):
+        return len(self.ops)
+
+    # Tuple view of a single op, same shape as the op constructors return
+    def __getitem__(self, ip):
+        op = self.ops[ip]
+        arg = self.args[ip]
+        return (op, arg) if op == OP_PUSH or arg >= 0 else (op, )
+
+    def __setitem__(self, ip, op):
+        self.ops[ip] = op[0]
+        self.args[ip] = op[1] if len(op) >= 2 else -1
+
+    def __eq__(self, other):
+        return (isinstance(other, Program) and self.ops == other.ops and self.args == other.args
+                and self.rows == other.rows and self.cols == other.cols and self.consts == other.consts
+                and [self.files[i] for i in self.file_ids] == [other.files[i] for i in other.file_ids])
+
+    def loc(self, ip):
+        return "%s:%d:%d" % (self.files[self.file_ids[ip]], self.rows[ip], self.cols[ip])
+
+# Lets the passes below also take a plain list of op tuples
+def as_program(program, tokens=None):
+    if isinstance(program, Program):
+        return program
+    result = Program()
+    for ip in range(len(program)):
+        result.append(program[ip], tokens[ip] if tokens is not None else None)
+    return result
+
+# Output of dump in the simulator
+# Numbers are formatted straight into a reusable byte buffer that is written
+# out in large chunks, once it grows past flush_size and when the program ends
+# or fails. With capture=True everything ends up in memory instead of stdout.
+SIM_OUTPUT_FLUSH_SIZE = 1 << 16
+
+class SimOutput:
+    def __init__(self, stream=None, capture=False, flush_size=SIM_OUTPUT_FLUSH_SIZE):
+        if capture:
+            stream = io.BytesIO()
+        elif stream is None:
+            sys.stdout.flush() # Anything already printed goes first
+            stream = sys.stdout.buffer
+        self.stream = stream
+        self.buffer = bytearray()
+        self.flush_size = flush_size
+
+    def dump(self, value):
+        self.buffer += b"%d\n" % value
+        if len(self.buffer) >= self.flush_size:
+            self.flush()
+
+    # Same as dump for every value, formatted in one go
+    def dump_all(self, values):
+        if values:
+            self.buffer += ("\n".join(map(str, values)) + "\n").encode()
+            if len(self.buffer) >= self.flush_size:
+                self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.stream.write(self.buffer)
+            del self.buffer[:]
+        self.stream.flush()
+
+    # Everything dumped so far, only for capture=True
+    def getvalue(self):
+        self.flush()
+        return self.stream.getvalue()
+
+# Static stack effect analysis
+# (values popped, values pushed) for every op, indexed by opcode
+STACK_EFFECTS = [
+    (0, 1), # push
+    (2, 1), # plus
+    (2, 1), # minus
+    (2, 1), # equal
+    (1, 0), # dump
+    (1, 0), # if
+    (0, 0), # end
+    (0, 0), # else
+    (1, 2), # dup
+    (2, 1), # gt
+    None,   # COUNT_OPS
+    (1, 1), # push+
+    (1, 1), # push-
+    (1, 2), # dup push>
+    (1, 1), # dup push> if
+    (1, 1), # dup dump
+]
+assert len(STACK_EFFECTS) == COUNT_FUSED_OPS, "Every op needs an entry in STACK_EFFECTS"
+
+def op_name(op):
+    return OP_NAMES[op] if op < COUNT_OPS else FUSED_OP_NAMES[op - COUNT_OPS - 1]
+
+def stack_error(program, ip, message):
+    print("%s: %s" % (program.loc(ip), message))
+    exit(1)
+
+# Walks the crossreferenced program once with the depth of the stack, the
+# branches of an if have to end at the same depth so after every op the depth
+# is the same no matter which way the program went. Reports underflow and
+# unbalanced or unclosed blocks, gives back the maximum depth.
+def analyze_stack(program):
+    program = as_program(program)
+    ops = program.ops
+    depth = 0
+    max_depth = 0
+    blocks = [] # (ip of the if, depth after the condition, depth at the end of the if branch or None)
+    for ip in range(len(ops)):
+        op = ops[ip]
+        (pops, pushes) = STACK_EFFECTS[op]
+        if depth < pops:
+            stack_error(program, ip, "stack underflow, '%s' needs %d value(s) but the stack only has %d" % (op_name(op), pops, depth))
+        depth += pushes - pops
+        if depth > max_depth:
+            max_depth = depth
+        if op == OP_IF or op == OP_DUP_PUSH_GT_IF:
+            blocks.append((ip, depth, None))
+        elif op == OP_ELSE:
+            (if_ip, if_depth, _) = blocks.pop()
+            blocks.append((if_ip, if_depth, depth))
+            depth = if_depth
+        elif op == OP_END:
+            (if_ip, if_depth, then_depth) = blocks.pop()
+            if then_depth is None and depth != if_depth:
+                stack_error(program, if_ip, "'if' without 'else' changes the stack from %d to %d value(s)" % (if_depth, depth))
+            if then_depth is not None and depth != then_depth:
+                stack_error(program, if_ip, "branches of 'if' leave %d and %d value(s) on the stack" % (then_depth, depth))
+    if blocks:
+        stack_error(program, blocks[-1][0], "'%s' is never closed with 'end'" % op_name(ops[blocks[-1][0]]))
+    program.max_depth = max_depth
+    return max_depth
+
 # Simulate, or "run" the program without compiling
-def simulate_program(program):
-    stack = []
+# The stack is a preallocated list of program.max_depth slots with sp pointing
+# at the first free one, analyze_stack has already proven it never underflows.
+def simulate_program(program, out=None):
+    program = as_program(program)
+    if program.max_depth is None:
+        analyze_stack(program)
+    if out is None:
+        out = SimOutput()
+    try:
+        run_program(program, out.dump)
+    finally:
+        out.flush()
+
+def run_program(program, dump):
+    ops = program.ops
+    args = program.args
+    stack = [0] * program.max_depth
+    sp = 0
     ip = 0
-    while ip < len(program):
+    while ip < len(ops):
         assert COUNT_OPS == 10, "Exhaustive handling of operations in simulation."
-        op = program[ip]
-        if op[0] == OP_PUSH:
-            stack.append(op[1]) # PUSH instruction
+        op = ops[ip]
+        if op == OP_PUSH:
+            stack[sp] = args[ip] # PUSH instruction
+            sp += 1
             ip += 1
-        elif op[0] == OP_PLUS:
-            a = stack.pop()
-            b = stack.pop()
-            stack.append(a + b) # ADD instruction
+        elif op == OP_PLUS:
+            sp -= 1
+            stack[sp - 1] += stack[sp] # ADD instruction
             ip += 1
-        elif op[0] == OP_MINUS:
-            a = stack.pop()
-            b = stack.pop()
-            stack.append(b - a) # SUB instruction
+        elif op == OP_MINUS:
+            sp -= 1
+            stack[sp - 1] -= stack[sp] # SUB instruction
             ip += 1
-        elif op[0] == OP_EQUAL:
-            a = stack.pop()
-            b = stack.pop()
-            stack.append(int(a == b)) # Returns boolean, cast to int
+        elif op == OP_EQUAL:
+            sp -= 1
+            stack[sp - 1] = int(stack[sp - 1] == stack[sp]) # Returns boolean, cast to int
             ip += 1
-        elif op[0] == OP_IF:
-            a = stack.pop()
-            if a == 0:
+        elif op == OP_IF:
+            sp -= 1
+            if stack[sp] == 0:
                 # jump to end
-                assert len(op) >= 2, "'if' instruction does not have reference to the end of it's block."
-                ip = op[1]           # Remember to call crossreference_block() here to simulate
+                assert args[ip] >= 0, "'if' instruction does not have reference to the end of it's block."
+                ip = args[ip]        # Remember to call crossreference_block() here to simulate
             else:
                 ip += 1
-        elif op[0] == OP_ELSE:
-            assert len(op) >= 2, "'else' instruction does not have reference to the end of it's block." # Same
-            ip = op[1]
-        elif op[0] == OP_END:
+        elif op == OP_ELSE:
+            assert args[ip] >= 0, "'else' instruction does not have reference to the end of it's block." # Same
+            ip = args[ip]
+        elif op == OP_END:
             ip += 1
-        elif op[0] == OP_DUMP:
-            a = stack.pop() # Just print results of stack
-            print(a)
+        elif op == OP_DUMP:
+            sp -= 1
+            dump(stack[sp]) # Just print results of stack
             ip += 1
-        elif op[0] == OP_DUP:
-            a = stack.pop()
-            stack.append(a)
-            stack.append(a) # Push back on stack twice
+        elif op == OP_DUP:
+            stack[sp] = stack[sp - 1] # Push the top again
+            sp += 1
             ip += 1
-        elif op[0] == OP_GT:
+        elif op == OP_GT:
             """ Commenting out my solution for now because I'm thinking like an idiot
             b = stack.pop() # I don't get why this is a problem but have to pop backwards
             a = stack.pop()
             stack.append(a if a > b else b) # This is a weird fcking ternary
             """
-            a = stack.pop()
-            b = stack.pop()
-            stack.append(int(a < b))
+            sp -= 1
+            stack[sp - 1] = int(stack[sp - 1] > stack[sp])
+            ip += 1
+        elif op == OP_PUSH_PLUS:
+            assert COUNT_FUSED_OPS == 16, "Exhaustive handling of fused operations in simulation."
+            stack[sp - 1] += args[ip]
             ip += 1
+        elif op == OP_PUSH_MINUS:
+            stack[sp - 1] -= args[ip]
+            ip += 1
+        elif op == OP_DUP_PUSH_GT:
+            stack[sp] = int(stack[sp - 1] > args[ip])
+            sp += 1
+            ip += 1
+        elif op == OP_DUP_PUSH_GT_IF:
+            (value, target) = program.consts[args[ip]]
+            if stack[sp - 1] > value:
+                ip += 1
+            else:
+                ip = target
+        elif op == OP_DUP_DUMP:
+            dump(stack[sp - 1])
+            ip += 1
+        else:
+            assert False, "unreachable"
+
+# Superinstruction fusion
+# Rewrites common sequences into the fused ops above after crossreferencing.
+# A sequence is only fused if nothing jumps into the middle of it, the
+# remaining jump targets are remapped to the shorter program.
+FUSION_PATTERNS = [
+    # (ops to match, fused op), longest patterns first
+    ((OP_DUP, OP_PUSH, OP_GT, OP_IF), OP_DUP_PUSH_GT_IF),
+    ((OP_DUP, OP_PUSH, OP_GT), OP_DUP_PUSH_GT),
+    ((OP_PUSH, OP_PLUS), OP_PUSH_PLUS),
+    ((OP_PUSH, OP_MINUS), OP_PUSH_MINUS),
+    ((OP_DUP, OP_DUMP), OP_DUP_DUMP),
+]
+
+def match_fusion(ops, args, targets, ip):
+    for (pattern, fused_op) in FUSION_PATTERNS:
+        end_ip = ip + len(pattern)
+        if tuple(ops[ip:end_ip]) != pattern:
+            continue
+        if any(inner_ip in targets for inner_ip in range(ip + 1, end_ip)):
+            continue
+        if fused_op == OP_DUP_PUSH_GT_IF and args[end_ip - 1] < 0:
+            continue # The if is not crossreferenced, leave it for the simulator to complain about
+        return (pattern, fused_op)
+    return None
+
+# Gives back the fused program and how many times every fused op was made
+def fuse_program(program):
+    program = as_program(program)
+    ops = program.ops
+    args = program.args
+    targets = set(args[ip] for ip in range(len(ops)) if ops[ip] == OP_IF or ops[ip] == OP_ELSE)
+    fused = Program()
+    stats = dict((name, 0) for name in FUSED_OP_NAMES)
+    new_ips = {}
+    ip = 0
+    while ip < len(ops):
+        new_ips[ip] = len(fused)
+        token = (program.files[program.file_ids[ip]], program.rows[ip], program.cols[ip], None)
+        match = match_fusion(ops, args, targets, ip)
+        if match is None:
+            fused.append((ops[ip], args[ip]), token)
+            ip += 1
+            continue
+        (pattern, fused_op) = match
+        stats[FUSED_OP_NAMES[fused_op - COUNT_OPS - 1]] += 1
+        if fused_op == OP_DUP_PUSH_GT_IF:
+            fused.consts.append((args[ip + 1], args[ip + 3]))
+            fused.append((fused_op, len(fused.consts) - 1), token)
+        elif fused_op == OP_DUP_DUMP:
+            fused.append((fused_op, -1), token)
+        else:
+            fused.append((fused_op, args[ip + pattern.index(OP_PUSH)]), token)
+        ip += len(pattern)
+    new_ips[len(ops)] = len(fused)
+
+    for ip in range(len(fused)):
+        op = fused.ops[ip]
+        if (op == OP_IF or op == OP_ELSE) and fused.args[ip] >= 0:
+            fused.args[ip] = new_ips[fused.args[ip]]
+    fused.consts = [(value, new_ips[target]) for (value, target) in fused.consts]
+    fused.max_depth = program.max_depth # Fusing never makes the stack deeper
+    return (fused, stats)
+
+def print_fusion_stats(program, fused, stats):
+    print("[INFO] Fused %d ops into %d" % (len(program), len(fused)), file=sys.stderr)
+    for name in sorted(stats, key=lambda name: -stats[name]):
+        print("[INFO]     %-14s %d" % (name, stats[name]), file=sys.stderr)
+
+# Fuses the program and runs the fused one with simulate, what sim --fuse runs
+def simulate_fused(program, out=None, simulate=simulate_program, print_stats=False):
+    (fused, stats) = fuse_program(program)
+    if print_stats:
+        print_fusion_stats(program, fused, stats)
+    simulate(fused, out)
+
+# Constant folding
+# Walks the crossreferenced program keeping the values on top of the stack
+# that are known at compile time as pending (value, ip) pairs instead of
+# pushes. Arithmetic, comparisons and dup on pending values happen right away,
+# an if on a pending value keeps only the branch that runs. Pending values get
+# pushed for real before anything that needs them on the stack, and before a
+# block that is kept ends so both ways into the end have the same stack.
+# Folded values stay within 32 bits, the range of a push in the compiled program.
+FOLD_MIN = -(1 << 31)
+FOLD_MAX = (1 << 31) - 1
+
+def fold_program(program):
+    program = as_program(program)
+    ops = program.ops
+    args = program.args
+    folded = Program()
+    stats = {"folded": 0, "branches": 0}
+    stack = [] # Block stack for crossreference_op on folded
+    pending = []
+    blocks = [] # True for an if that is kept, False for one that was resolved
+
+    def token(ip):
+        return (program.files[program.file_ids[ip]], program.rows[ip], program.cols[ip], None)
+
+    def emit(op, ip):
+        folded.append(op, token(ip))
+        crossreference_op(folded, stack, len(folded) - 1)
+
+    def flush():
+        for (value, ip) in pending:
+            emit(push(value), ip)
+        del pending[:]
+
+    assert COUNT_OPS == 10, "Exhaustive handling of ops in fold_program"
+    ip = 0
+    while ip < len(ops):
+        op = ops[ip]
+        assert op < COUNT_OPS, "Constant folding only works on unfused programs"
+        if op == OP_PUSH:
+            pending.append((args[ip], ip))
+        elif op in (OP_PLUS, OP_MINUS, OP_EQUAL, OP_GT) and len(pending) >= 2:
+            a = pending[-2][0]
+            b = pending[-1][0]
+            if op == OP_PLUS:
+                value = a + b
+            elif op == OP_MINUS:
+                value = a - b
+            elif op == OP_EQUAL:
+                value = int(a == b)
+            else:
+                value = int(a > b)
+            if FOLD_MIN <= value <= FOLD_MAX:
+                pending[-2:] = [(value, ip)]
+                stats["folded"] += 1
+            else:
+                flush()
+                emit((op, ), ip)
+        elif op == OP_DUP and pending:
+            pending.append((pending[-1][0], ip))
+            stats["folded"] += 1
+        elif op == OP_DUMP and pending:
+            (value, value_ip) = pending.pop() # Only the dumped value needs to be pushed
+            emit(push(value), value_ip)
+            emit((op, ), ip)
+        elif op == OP_IF and pending:
+            (value, _) = pending.pop()
+            target = args[ip]
+            has_else = ops[target - 1] == OP_ELSE
+            stats["branches"] += 1
+            if value != 0:
+                blocks.append(False) # Skip the else branch if it comes, drop the end
+            elif has_else:
+                blocks.append(False) # Run the else branch, drop its end
+                ip = target
+                continue
+            else:
+                ip = target + 1 # Past the end
+                continue
+        elif op == OP_IF:
+            blocks.append(True)
+            emit((op, ), ip)
+        elif op == OP_ELSE:
+            if blocks[-1]:
+                flush()
+                emit((op, ), ip)
+            else:
+                blocks.pop()
+                ip = args[ip] + 1 # The then branch ran, skip the else and its end
+                continue
+        elif op == OP_END:
+            if blocks.pop():
+                flush()
+                emit((op, ), ip)
+        else:
+            flush()
+            emit((op, ), ip)
+        ip += 1
+    flush() # Values left on the stack at the end were never used, keep them anyway
+    return (folded, stats)
+
+# Closure compiled simulator
+# The program is decoded once into straight-line blocks of handlers plus a
+# branch function per block that pops the condition if it has to and gives back
+# the ip of the next block. Jump targets are resolved while decoding, so running
+# the program does no opcode comparisons and no checks at all.
+def decode_jump(target):
+    def branch():
+        return target
+    return branch
+
+def decode_if(pop, target, next_ip):
+    if target < 0:
+        # Not crossreferenced, only fails once the jump is actually taken, like simulate_program
+        def branch():
+            if pop() == 0:
+                assert False, "'if' instruction does not have reference to the end of it's block."
+            return next_ip
+        return branch
+    def branch():
+        return next_ip if pop() else target
+    return branch
+
+def decode_dup_push_gt_if(stack, value, target, next_ip):
+    def branch():
+        return next_ip if stack[-1] > value else target
+    return branch
+
+# Handler for a fused op that doesn't jump
+def decode_fused(stack, dump, op, value):
+    assert COUNT_FUSED_OPS == 16, "Exhaustive handling of fused operations in decode_fused."
+    if op == OP_PUSH_PLUS:
+        def handler():
+            stack[-1] += value
+    elif op == OP_PUSH_MINUS:
+        def handler():
+            stack[-1] -= value
+    elif op == OP_DUP_PUSH_GT:
+        append = stack.append
+        def handler():
+            append(int(stack[-1] > value))
+    elif op == OP_DUP_DUMP:
+        def handler():
+            dump(stack[-1])
+    else:
+        assert False, "unreachable"
+    return handler
+
+# Gives back a list indexed by ip with a (handlers, branch) pair wherever a block starts
+# wrap(handler, ip) if given replaces every handler and branch of an op, see profile_program
+def decode_program(program, stack, dump, wrap=None):
+    program = as_program(program)
+    ops = program.ops
+    args = program.args
+    append = stack.append
+    pop = stack.pop
+
+    def plus():
+        a = pop()
+        append(pop() + a)
+    def minus():
+        a = pop()
+        append(pop() - a)
+    def equal():
+        append(int(pop() == pop()))
+    def dump_handler():
+        dump(pop())
+    def dup():
+        append(stack[-1])
+    def gt():
+        a = pop()
+        append(int(pop() > a))
+
+    assert COUNT_OPS == 10, "Exhaustive handling of operations in decode_program."
+    handlers = {OP_PLUS: plus, OP_MINUS: minus, OP_EQUAL: equal, OP_DUMP: dump_handler, OP_DUP: dup, OP_GT: gt}
+
+    # Every jump target starts a block, so does everything right after a jump
+    leaders = set()
+    for ip in range(len(ops)):
+        if ops[ip] == OP_IF or ops[ip] == OP_ELSE:
+            leaders.add(args[ip])
+            leaders.add(ip + 1)
+        elif ops[ip] == OP_DUP_PUSH_GT_IF:
+            leaders.add(program.consts[args[ip]][1])
+            leaders.add(ip + 1)
+
+    # Decoding makes lots of small objects that are never garbage,
+    # don't let the collector walk over them again and again
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return decode_blocks(program, stack, dump, leaders, handlers, wrap)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+def decode_blocks(program, stack, dump, leaders, handlers, wrap=None):
+    ops = program.ops
+    args = program.args
+    append = stack.append
+    pop = stack.pop
+    blocks = [None] * len(ops)
+    start = 0
+    body = []
+    for ip in range(len(ops)):
+        if ip in leaders and ip != start:
+            blocks[start] = (tuple(body), decode_jump(ip))
+            start = ip
+            body = []
+        op = ops[ip]
+        if op == OP_PUSH:
+            handler = partial(append, args[ip])
+            body.append(handler if wrap is None else wrap(handler, ip))
+        elif op == OP_IF:
+            branch = decode_if(pop, args[ip], ip + 1)
+            blocks[start] = (tuple(body), branch if wrap is None else wrap(branch, ip))
+            start = ip + 1
+            body = []
+        elif op == OP_ELSE:
+            assert args[ip] >= 0, "'else' instruction does not have reference to the end of it's block."
+            branch = decode_jump(args[ip])
+            blocks[start] = (tuple(body), branch if wrap is None else wrap(branch, ip))
+            start = ip + 1
+            body = []
+        elif op == OP_END:
+            # Only a jump target, which already started a block
+            if wrap is not None:
+                body.append(wrap(None, ip))
+        elif op == OP_DUP_PUSH_GT_IF:
+            (value, target) = program.consts[args[ip]]
+            branch = decode_dup_push_gt_if(stack, value, target, ip + 1)
+            blocks[start] = (tuple(body), branch if wrap is None else wrap(branch, ip))
+            start = ip + 1
+            body = []
+        elif op > COUNT_OPS:
+            handler = decode_fused(stack, dump, op, args[ip])
+            body.append(handler if wrap is None else wrap(handler, ip))
+        else:
+            body.append(handlers[op] if wrap is None else wrap(handlers[op], ip))
+    if start < len(ops):
+        blocks[start] = (tuple(body), decode_jump(len(ops)))
+    return blocks
+
+def run_blocks(blocks):
+    ip = 0
+    count = len(blocks)
+    while ip < count:
+        (body, branch) = blocks[ip]
+        for handler in body:
+            handler()
+        ip = branch()
+
+def simulate_program_closure(program, out=None):
+    if out is None:
+        out = SimOutput()
+    stack = []
+    try:
+        run_blocks(decode_program(program, stack, out.dump))
+    finally:
+        out.flush()
+
+# Profiling
+# The closure engine with every handler wrapped to count how often its op ran
+# and how long it took, nothing is wrapped when not profiling. Times include
+# the profiling itself so they are best compared against each other.
+def profile_program(program, out=None):
+    program = as_program(program)
+    counts = [0] * len(program)
+    times = [0] * len(program) # Nanoseconds
+    clock = time.perf_counter_ns
+
+    def wrap(handler, ip):
+        if handler is None:
+            def handler(): # end does nothing but still counts
+                pass
+        def profiled():
+            start = clock()
+            result = handler()
+            times[ip] += clock() - start
+            counts[ip] += 1
+            return result
+        return profiled
+
+    if out is None:
+        out = SimOutput()
+    stack = []
+    try:
+        run_blocks(decode_program(program, stack, out.dump, wrap))
+    finally:
+        out.flush()
+    return (counts, times)
+
+PROFILE_TOP_IPS = 20
+
+def print_profile(program, counts, times, file=sys.stderr):
+    total_count = sum(counts)
+    total_time = sum(times) or 1
+    by_op = {}
+    for ip in range(len(counts)):
+        if counts[ip]:
+            (count, spent) = by_op.get(program.ops[ip], (0, 0))
+            by_op[program.ops[ip]] = (count + counts[ip], spent + times[ip])
+    print("[INFO] Executed %d ops in %.3fms" % (total_count, total_time / 1e6), file=file)
+    print("[INFO]     %-14s %12s %12s %7s" % ("op", "count", "time", "time%"), file=file)
+    for op in sorted(by_op, key=lambda op: -by_op[op][1]):
+        (count, spent) = by_op[op]
+        print("[INFO]     %-14s %12d %10.3fms %6.1f%%" % (op_name(op), count, spent / 1e6, 100 * spent / total_time), file=file)
+    hot = sorted((ip for ip in range(len(counts)) if counts[ip]), key=lambda ip: (-counts[ip], -times[ip]))
+    print("[INFO] Hottest %d of %d executed ips" % (min(len(hot), PROFILE_TOP_IPS), len(hot)), file=file)
+    print("[INFO]     %-14s %12s %12s  %s" % ("op", "count", "time", "location"), file=file)
+    for ip in hot[:PROFILE_TOP_IPS]:
+        print("[INFO]     %-14s %12d %10.3fms  %s" % (op_name(program.ops[ip]), counts[ip], times[ip] / 1e6, program.loc(ip)), file=file)
+
+# One line per executed ip in the collapsed stack format flamegraph.pl and
+# speedscope read: the file, then every if or else branch the op is in, then
+# the op itself, each named with its location, and the nanoseconds spent there
+def save_folded_profile(program, counts, times, folded_path):
+    ops = program.ops
+    frames = []
+    with open(folded_path, "w") as f:
+        for ip in range(len(ops)):
+            op = ops[ip]
+            if op == OP_ELSE or op == OP_END:
+                frames.pop()
+            frame = "%s %d:%d" % (op_name(op), program.rows[ip], program.cols[ip])
+            if counts[ip]:
+                root = path.basename(program.files[program.file_ids[ip]])
+                f.write("%s %d\n" % (";".join([root] + frames + [frame]), times[ip]))
+            if op == OP_IF or op == OP_ELSE or op == OP_DUP_PUSH_GT_IF:
+                frames.append(frame)
+
+# Profiles a run, prints the profile and saves it to folded_path, what sim --profile runs
+def simulate_profiled(program, out=None, folded_path=None):
+    (counts, times) = profile_program(program, out)
+    print_profile(program, counts, times)
+    save_folded_profile(program, counts, times, folded_path)
+    print("[INFO] Saved collapsed stacks to %s" % folded_path, file=sys.stderr)
+
+# Execution trace
+# The closure engine with every handler wrapped to write the ip, opcode and
+# top of the stack into a ring buffer of the last size ops before the op runs,
+# through the same hook profile_program uses. The buffer is allocated up front
+# so tracing allocates nothing per op. It is printed when the program fails an
+# assert or pops an empty stack, and whenever the process gets SIGUSR1. Gives
+# back the trace as (ips, opcodes, tops, [executed]) for print_trace.
+def trace_program(program, size, out=None):
+    program = as_program(program)
+    assert size > 0, "Trace needs room for at least one op"
+    ops = program.ops
+    trace = (array("q", bytes(8 * size)), array("q", bytes(8 * size)), [None] * size, [0]) # ips, opcodes, tops, [executed]
+    (ips, opcodes, tops, executed) = trace
+    stack = []
+
+    def wrap(handler, ip):
+        op = ops[ip]
+        if handler is None:
+            def handler(): # end does nothing but still shows up in the trace
+                pass
+        def traced():
+            n = executed[0]
+            slot = n % size
+            ips[slot] = ip
+            opcodes[slot] = op
+            tops[slot] = stack[-1] if stack else None
+            executed[0] = n + 1
+            return handler()
+        return traced
+
+    def print_current_trace(*_):
+        print_trace(program, *trace)
+
+    if out is None:
+        out = SimOutput()
+    blocks = decode_program(program, stack, out.dump, wrap)
+    previous_handler = signal.signal(signal.SIGUSR1, print_current_trace)
+    try:
+        run_blocks(blocks)
+    except (AssertionError, IndexError):
+        out.flush()
+        print_current_trace()
+        raise
+    finally:
+        signal.signal(signal.SIGUSR1, previous_handler)
+        out.flush()
+    return trace
+
+def print_trace(program, ips, opcodes, tops, executed, file=sys.stderr):
+    executed = executed[0]
+    size = len(ips)
+    count = min(executed, size)
+    print("[TRACE] Last %d of %d executed ops, oldest first" % (count, executed), file=file)
+    print("[TRACE]     %12s %-14s %20s  %s" % ("#", "op", "top of stack", "location"), file=file)
+    for n in range(executed - count, executed):
+        slot = n % size
+        top = "empty" if tops[slot] is None else "%d" % tops[slot]
+        print("[TRACE]     %12d %-14s %20s  %s" % (n, op_name(opcodes[slot]), top, program.loc(ips[slot])), file=file)
+    file.flush()
+
+# Porth to Python translation
+# The whole program becomes the body of one Python function. While the stack
+# depth is statically known every stack slot is a local (s0, s1, ...) and
+# if/else turn into Python if/else. Anything where the depth can't be known,
+# like branches that leave different depths or popping an empty stack, is left
+# to the interpreter.
+JIT_MAX_NESTING = 90 # Python won't indent much deeper than 100 levels
+
+def jit_translate(program):
+    program = as_program(program)
+    ops = program.ops
+    args = program.args
+    lines = ["def porth_jit(dump):"]
+    indent = "    "
+    depth = 0
+    blocks = [] # (ip of the if, depth after popping the condition, depth at the end of the if branch or None)
+    for ip in range(len(ops)):
+        assert COUNT_OPS == 10, "Exhaustive handling of operations in jit_translate."
+        op = ops[ip]
+        if depth < STACK_EFFECTS[op][0]:
+            return None
+        if op == OP_PUSH:
+            lines.append("%ss%d = %d" % (indent, depth, args[ip]))
+            depth += 1
+        elif op == OP_DUP:
+            lines.append("%ss%d = s%d" % (indent, depth, depth - 1))
+            depth += 1
+        elif op == OP_DUMP:
+            depth -= 1
+            lines.append("%sdump(s%d)" % (indent, depth))
+        elif op in (OP_PLUS, OP_MINUS, OP_EQUAL, OP_GT):
+            depth -= 1
+            (b, a) = (depth - 1, depth)
+            if op == OP_PLUS:
+                lines.append("%ss%d = s%d + s%d" % (indent, b, b, a))
+            elif op == OP_MINUS:
+                lines.append("%ss%d = s%d - s%d" % (indent, b, b, a))
+            elif op == OP_EQUAL:
+                lines.append("%ss%d = int(s%d == s%d)" % (indent, b, b, a))
+            else:
+                lines.append("%ss%d = int(s%d > s%d)" % (indent, b, b, a))
+        elif op == OP_IF:
+            if args[ip] < 0 or len(blocks) >= JIT_MAX_NESTING:
+                return None
+            depth -= 1
+            lines.append("%sif s%d:" % (indent, depth))
+            lines.append("%s    pass" % indent)
+            blocks.append((ip, depth, None))
+            indent += "    "
+        elif op == OP_ELSE:
+            (if_ip, if_depth, _) = blocks.pop()
+            indent = indent[:-4]
+            lines.append("%selse:" % indent)
+            lines.append("%s    pass" % indent)
+            blocks.append((if_ip, if_depth, depth))
+            indent += "    "
+            depth = if_depth
+        elif op == OP_END:
+            (if_ip, if_depth, then_depth) = blocks.pop()
+            if depth != (if_depth if then_depth is None else then_depth):
+                return None # Branches leave the stack at different depths
+            indent = indent[:-4]
         else:
             assert False, "unreachable"
+    if blocks:
+        return None # Unclosed block
+    if len(lines) == 1:
+        lines.append("    pass")
+    return "\n".join(lines) + "\n"
+
+# Gives back the translated function, or None if the program can't be translated
+def jit_compile(program):
+    source = jit_translate(program)
+    if source is None:
+        return None
+    scope = {}
+    try:
+        exec(compile(source, "<porth jit>", "exec"), scope)
+    except (SyntaxError, RecursionError, MemoryError):
+        return None # Too big or too deep for Python to compile
+    return scope["porth_jit"]
+
+def simulate_program_jit(program, fallback=simulate_program, out=None):
+    porth_jit = jit_compile(program)
+    if porth_jit is None:
+        fallback(program, out)
+        return
+    if out is None:
+        out = SimOutput()
+    try:
+        porth_jit(out.dump)
+    finally:
+        out.flush()
+
+# Batch simulation, one lane per row of seeds
+# Every lane runs the same program with some push literals replaced. The
+# stack is max_depth columns of int64 arrays with one entry per lane and
+# if/else runs both branches under a mask of the lanes that took them,
+# skipping a branch when no lane did. A lane where plus or minus leaves 64
+# bits is run again on its own with run_program, which has no such limit, so
+# every lane prints what sim prints. NumPy is only needed for this mode.
+def load_batch_seeds(program, seeds_path):
+    import csv
+    literals = {}
+    for ip in range(len(program)):
+        if program.ops[ip] == OP_PUSH:
+            literals["%d:%d" % (program.rows[ip], program.cols[ip])] = ip
+    try:
+        with open(seeds_path, newline="") as f:
+            rows = list(csv.reader(f))
+    except OSError as e:
+        print("Error: Could not read %s: %s" % (seeds_path, e.strerror))
+        exit(1)
+    if len(rows) < 1:
+        print("%s: expected a header of literal locations <row>:<col>" % seeds_path)
+        exit(1)
+    header, *rows = rows
+    ips = []
+    for (col, field) in enumerate(header):
+        ip = literals.get(field.strip())
+        if ip is None:
+            print("%s:0:%d: no integer literal at %s in the program" % (seeds_path, col, field.strip()))
+            exit(1)
+        ips.append(ip)
+    lanes = []
+    for (row, values) in enumerate(rows, 1):
+        if not values:
+            continue
+        if len(values) != len(ips):
+            print("%s:%d:0: expected %d value(s) but got %d" % (seeds_path, row, len(ips), len(values)))
+            exit(1)
+        try:
+            lanes.append([int(value) for value in values])
+        except ValueError as e:
+            print("%s:%d:0: %s" % (seeds_path, row, e))
+            exit(1)
+    return (ips, lanes)
+
+def simulate_program_batch(program, ips, lanes, out=None):
+    try:
+        import numpy as np
+    except ImportError:
+        print("Error: sim --batch needs NumPy, install it with `pip install numpy`")
+        exit(1)
+    program = as_program(program)
+    if program.max_depth is None:
+        analyze_stack(program)
+    if out is None:
+        out = SimOutput()
+    count = len(lanes)
+    if count == 0:
+        out.flush()
+        return
+    ops = program.ops
+    args = program.args
+    try:
+        seeds = np.array(lanes, dtype=np.int64).reshape(count, len(ips))
+    except OverflowError:
+        print("Error: seed values have to fit in 64 bits")
+        exit(1)
+    overrides = {ip: np.ascontiguousarray(seeds[:, i]) for (i, ip) in enumerate(ips)}
+    stack = np.zeros((max(program.max_depth, 1), count), dtype=np.int64)
+    dumped = [] # (lanes that dumped or None for all of them, values)
+    overflowed = np.zeros(count, dtype=bool) # Lanes whose values wrapped around
+
+    # Runs ops[start:stop] for the lanes in mask, None meaning every lane
+    def run(start, stop, mask, sp):
+        ip = start
+        while ip < stop:
+            op = ops[ip]
+            if op == OP_PUSH:
+                value = overrides.get(ip)
+                if value is None:
+                    value = args[ip]
+                if mask is None:
+                    stack[sp] = value
+                else:
+                    np.copyto(stack[sp], value, where=mask)
+                sp += 1
+            elif op == OP_DUMP:
+                sp -= 1
+                if mask is None:
+                    dumped.append((None, stack[sp].copy()))
+                else:
+                    dumped.append((np.flatnonzero(mask), stack[sp][mask]))
+            elif op == OP_DUP:
+                if mask is None:
+                    stack[sp] = stack[sp - 1]
+                else:
+                    np.copyto(stack[sp], stack[sp - 1], where=mask)
+                sp += 1
+            elif op == OP_IF:
+                sp -= 1
+                cond = stack[sp] != 0
+                target = args[ip]
+                has_else = ops[target - 1] == OP_ELSE # The if jumps past its else
+                then_mask = cond if mask is None else cond & mask
+                else_mask = ~cond if mask is None else ~cond & mask
+                then_stop = target - 1 if has_else else target
+                end_ip = args[target - 1] if has_else else target
+                after = sp
+                if then_mask.any():
+                    after = run(ip + 1, then_stop, None if then_mask.all() else then_mask, sp)
+                if has_else and else_mask.any():
+                    after = run(target, end_ip, None if else_mask.all() else else_mask, sp)
+                sp = after
+                ip = end_ip
+            else:
+                assert op == OP_PLUS or op == OP_MINUS or op == OP_EQUAL or op == OP_GT, "Batch simulation only runs unfused programs"
+                sp -= 1
+                a = stack[sp - 1]
+                b = stack[sp]
+                if op == OP_PLUS:
+                    value = a + b
+                    wrapped = ((a ^ value) & (b ^ value)) < 0 # Both operands have the other sign than the sum
+                    overflowed[wrapped if mask is None else wrapped & mask] = True
+                elif op == OP_MINUS:
+                    value = a - b
+                    wrapped = ((a ^ b) & (a ^ value)) < 0 # The operands differ in sign and the difference took b's
+                    overflowed[wrapped if mask is None else wrapped & mask] = True
+                elif op == OP_EQUAL:
+                    value = a == b
+                else:
+                    value = a > b
+                if mask is None:
+                    stack[sp - 1] = value
+                else:
+                    np.copyto(stack[sp - 1], value, where=mask)
+            ip += 1
+        return sp
+
+    assert COUNT_OPS == 10, "Exhaustive handling of ops in simulate_program_batch"
+    run(0, len(ops), None, 0)
+
+    # Regroup the dumps lane by lane, in the order each lane made them
+    values = []
+    lane_ids = np.zeros(0, dtype=np.int64)
+    if dumped:
+        lane_ids = np.concatenate([np.arange(count) if who is None else who for (who, _) in dumped])
+        order = np.argsort(lane_ids, kind="stable")
+        values = np.concatenate([values for (_, values) in dumped])[order].tolist()
+        lane_ids = lane_ids[order]
+    if overflowed.any():
+        bounds = np.searchsorted(lane_ids, np.arange(count + 1)).tolist()
+        values = [value for lane in range(count) for value in
+                  (run_batch_lane(program, ips, lanes[lane]) if overflowed[lane] else values[bounds[lane]:bounds[lane + 1]])]
+    out.dump_all(values)
+    out.flush()
+
+# Runs one lane of simulate_program_batch with run_program, gives back what it dumped
+def run_batch_lane(program, ips, seeds):
+    args = program.args
+    originals = [args[ip] for ip in ips]
+    dumped = []
+    try:
+        for (ip, seed) in zip(ips, seeds):
+            args[ip] = seed
+        run_program(program, dumped.append)
+    finally:
+        for (ip, original) in zip(ips, originals):
+            args[ip] = original
+    return dumped
+
+SIM_ENGINES = {
+    "ladder": simulate_program,
+    "closure": simulate_program_closure,
+}
 
 # Compile the program to assembly
-def compile_program(program, out_file_path):
-    # Generate assembly
-    with open(out_file_path, "w") as out:
-        # Boilerplate
-        out.write("BITS 64\n")
-        out.write("segment .text\n")
-        # dump() - start
-        out.write("dump:\n")
-        out.write("    mov  r9, -3689348814741910323\n")
-        out.write("    sub  rsp, 40\n")
-        out.write("    mov  BYTE [rsp+31], 10\n")
-        out.write("    lea  rcx, [rsp+30]\n")
-        out.write(".L2:\n")
-        out.write("    mov  rax, rdi\n")
-        out.write("    lea  r8, [rsp+32]\n")
-        out.write("    mul  r9\n")
-        out.write("    mov  rax, rdi\n")
-        out.write("    sub  r8, rcx\n")
-        out.write("    shr  rdx, 3\n")
-        out.write("    lea  rsi, [rdx+rdx*4]\n")
-        out.write("    add  rsi, rsi\n")
-        out.write("    sub  rax, rsi\n")
-        out.write("    add  eax, 48\n")
-        out.write("    mov  BYTE [rcx], al\n")
-        out.write("    mov  rax, rdi\n")
-        out.write("    mov  rdi, rdx\n")
-        out.write("    mov  rdx, rcx\n")
-        out.write("    sub  rcx, 1\n")
-        out.write("    cmp  rax, 9\n")
-        out.write("    ja   .L2\n")
-        out.write("    lea  rax, [rsp+32]\n")
-        out.write("    mov  edi, 1\n")
-        out.write("    sub  rdx, rax\n")
-        out.write("    xor  eax, eax\n")
-        out.write("    lea  rsi, [rsp+32+rdx]\n")
-        out.write("    mov  rdx, r8\n")
-        out.write("    mov  rax, 1\n")  # Call write syscall
-        out.write("    syscall\n")
-        out.write("    add  rsp, 40\n")
-        out.write("    ret\n")
-        # dump() - end
-        # _start() - start
-        out.write("global _start\n")
-        out.write("_start:\n")
-        for ip in range(len(program)):
-            op = program[ip] # Refactoring to be able to store values
-            assert COUNT_OPS == 10, "Exhaustive handling of ops in compilation"
-            if op[0] == OP_PUSH:
-                out.write("    ;; -- push --\n")
-                out.write(f"    push  {op[1]}\n")
-            elif op[0] == OP_PLUS:
-                out.write("    ;; -- plus --\n")
-                out.write("    pop  rax\n")
-                out.write("    pop  rbx\n")
-                out.write("    add  rax, rbx\n") # Add two numbers present in rax, rbx
-                out.write("    push rax\n")
-            elif op[0] == OP_MINUS:
-                out.write("    ;; -- minus --\n")
-                out.write("    pop  rax\n")
-                out.write("    pop  rbx\n")
-                out.write("    sub  rbx, rax\n") # Sub rbx with rax
-                out.write("    push rbx\n")
-            elif op[0] == OP_EQUAL:
-                out.write("    ;; -- equal --\n")
-                out.write("    mov rcx, 0\n") # fill rcx with 0
-                out.write("    mov rdx, 1\n") 
-                out.write("    pop rax\n")
-                out.write("    pop rbx\n")
-                out.write("    cmp rax, rbx\n") 
-                out.write("    cmove rcx, rdx\n") # Move 1 into rcx if rax and rbx are eql
-                out.write("    push  rcx\n") # Push out result
-            elif op[0] == OP_DUMP:
-                out.write("    ;; -- dump --\n")
+# Qwords reserved on top of the deepest the program goes, for the return addresses and frame of dump
+COMPILED_STACK_SLACK = 8
+
+# Bytes of output dump collects in .bss before it makes a write syscall
+COMPILED_OUTPUT_SIZE = 64 * 1024
+
+# Most bytes one dump adds to the output, 20 digits of the largest uint64 and the newline
+COMPILED_DUMP_MAX = 21
+
+# Everything before the first op, the same for every program
+COMPILED_PROLOGUE = (
+    # Boilerplate
+    "BITS 64\n"
+    "segment .text\n"
+    # dump() - start
+    "dump:\n"
+    "    cmp  QWORD [porth_out_len], %d\n" % (COMPILED_OUTPUT_SIZE - COMPILED_DUMP_MAX) + # Flush first if the number might not fit
+    "    jbe  .format\n"
+    "    push rdi\n"
+    "    call flush\n"
+    "    pop  rdi\n"
+    ".format:\n"
+    "    sub  rsp, 24\n" # Digits are formatted backwards into [rsp, rsp+24)
+    "    lea  rsi, [rsp+24]\n"
+    "    mov  rax, rdi\n"
+    "    mov  r9, 2951479051793528259\n" # (x >> 2) * r9 >> 66 is x / 100
+    ".pairs:\n"
+    "    cmp  rax, 100\n"
+    "    jb   .last\n"
+    "    mov  rcx, rax\n"
+    "    shr  rax, 2\n"
+    "    mul  r9\n"
+    "    shr  rdx, 2\n"
+    "    imul rax, rdx, 100\n"
+    "    sub  rcx, rax\n" # rcx = x % 100, rdx = x / 100
+    "    movzx ecx, WORD [digit_pairs+rcx*2]\n" # Two digits per division
+    "    sub  rsi, 2\n"
+    "    mov  WORD [rsi], cx\n"
+    "    mov  rax, rdx\n"
+    "    jmp  .pairs\n"
+    ".last:\n"
+    "    cmp  rax, 10\n"
+    "    jb   .digit\n"
+    "    movzx ecx, WORD [digit_pairs+rax*2]\n"
+    "    sub  rsi, 2\n"
+    "    mov  WORD [rsi], cx\n"
+    "    jmp  .copy\n"
+    ".digit:\n"
+    "    add  eax, 48\n"
+    "    sub  rsi, 1\n"
+    "    mov  BYTE [rsi], al\n"
+    ".copy:\n"
+    "    lea  rcx, [rsp+24]\n"
+    "    sub  rcx, rsi\n" # Number of digits
+    "    mov  rdx, [porth_out_len]\n"
+    "    lea  rdi, [porth_out+rdx]\n"
+    "    lea  rdx, [rdx+rcx+1]\n"
+    "    mov  [porth_out_len], rdx\n"
+    "    rep  movsb\n" # Append the digits to the output
+    "    mov  BYTE [rdi], 10\n"
+    "    add  rsp, 24\n"
+    "    ret\n"
+    # dump() - end
+    # flush() - start
+    "flush:\n"
+    "    mov  rsi, porth_out\n"
+    "    mov  rdx, [porth_out_len]\n"
+    "    mov  QWORD [porth_out_len], 0\n"
+    ".write:\n"
+    "    test rdx, rdx\n"
+    "    jz   .done\n"
+    "    mov  rax, 1\n" # Call write syscall until all of it is out, pipes can take less
+    "    mov  rdi, 1\n"
+    "    syscall\n"
+    "    test rax, rax\n"
+    "    jle  .done\n" # Nothing more can be done about a failing stdout
+    "    add  rsi, rax\n"
+    "    sub  rdx, rax\n"
+    "    jmp  .write\n"
+    ".done:\n"
+    "    ret\n"
+    # flush() - end
+    # _start() - start
+    "global _start\n"
+    "_start:\n"
+    "    mov  rsp, porth_stack_end\n" # Run on our own stack, sized by analyze_stack
+)
+
+# Everything after the last op, the stack size goes in
+COMPILED_EPILOGUE = (
+    "    call flush\n" # Whatever dump left in the output
+    "    mov  rax, 60\n" # syscall for exit
+    "    mov  rdi, 0\n"
+    "    syscall\n"
+    "segment .rodata\n"
+    "digit_pairs: db \"%s\"\n" % "".join("%02d" % n for n in range(100)) +
+    "segment .bss\n"
+    "porth_out: resb %d\n" % COMPILED_OUTPUT_SIZE +
+    "porth_out_len: resq 1\n"
+    "porth_stack: resq %d\n"
+    "porth_stack_end:\n"
+)
+
+# Every op pops its operands from the stack in memory and pushes its result back,
+# the text for each is the same every time apart from the numbers
+COMPILED_OP_TEMPLATES = [None] * COUNT_OPS
+COMPILED_OP_TEMPLATES[OP_PUSH] = (
+    "    ;; -- push --\n"
+    "    push  %d\n"
+)
+COMPILED_OP_TEMPLATES[OP_PLUS] = (
+    "    ;; -- plus --\n"
+    "    pop  rax\n"
+    "    pop  rbx\n"
+    "    add  rax, rbx\n" # Add two numbers present in rax, rbx
+    "    push rax\n"
+)
+COMPILED_OP_TEMPLATES[OP_MINUS] = (
+    "    ;; -- minus --\n"
+    "    pop  rax\n"
+    "    pop  rbx\n"
+    "    sub  rbx, rax\n" # Sub rbx with rax
+    "    push rbx\n"
+)
+COMPILED_OP_TEMPLATES[OP_EQUAL] = (
+    "    ;; -- equal --\n"
+    "    mov rcx, 0\n" # fill rcx with 0
+    "    mov rdx, 1\n"
+    "    pop rax\n"
+    "    pop rbx\n"
+    "    cmp rax, rbx\n"
+    "    cmove rcx, rdx\n" # Move 1 into rcx if rax and rbx are eql
+    "    push  rcx\n" # Push out result
+)
+COMPILED_OP_TEMPLATES[OP_DUMP] = (
+    "    ;; -- dump --\n"
+    "    pop  rdi\n"
+    "    call dump\n" # Calls the dump function which calls write
+)
+COMPILED_OP_TEMPLATES[OP_IF] = (
+    "    ;; -- if --\n"
+    "    pop  rax\n" # Pop current value ontop of stack
+    "    test rax, rax\n" # Check if equal to zero
+    "    jz  addr_%d\n" # Jump to address available in op, if equal to zero
+)
+COMPILED_OP_TEMPLATES[OP_ELSE] = (
+    "    ;; -- else --\n"
+    "     jmp  addr_%d\n" # Just jump to addr that sits in tuple
+    "addr_%d:\n" # Addr that follows if
+)
+COMPILED_OP_TEMPLATES[OP_END] = (
+    "addr_%d:\n" # End to jump to, not indented
+)
+COMPILED_OP_TEMPLATES[OP_DUP] = (
+    "    ;; -- dup --\n"
+    "    pop  rax\n"
+    "    push rax\n" # Pop and push twice, like in simulation
+    "    push rax\n"
+)
+COMPILED_OP_TEMPLATES[OP_GT] = (
+    "    ;; -- gt --\n"
+    "    mov rcx, 0\n"
+    "    mov rdx, 1\n"
+    "    pop rbx\n" # Pop different order from equal, because number order matters here
+    "    pop rax\n" # Mostly because how we add rcx and rdx in above order
+    "    cmp rax, rbx\n"
+    "    cmovg rcx, rdx\n"
+    "    push rcx\n"
+)
+assert COUNT_OPS == 10 and None not in COMPILED_OP_TEMPLATES, "Every op needs a template in COMPILED_OP_TEMPLATES"
+
+# Fills in the templates for the whole program and hands them over in one go
+def compile_ops(out, program):
+    ops = program.ops
+    args = program.args
+    templates = COMPILED_OP_TEMPLATES
+    texts = []
+    for ip in range(len(ops)):
+        op = ops[ip]
+        if op == OP_PUSH:
+            texts.append(templates[op] % args[ip])
+        elif op == OP_IF or op == OP_ELSE:
+            assert args[ip] >= 0, "From compilation: '%s' instruction does not have a reference to the end of it's block. Call crossreference_blocks()." % OP_NAMES[op]
+            texts.append(templates[op] % ((args[ip], ) if op == OP_IF else (args[ip], ip + 1)))
+        elif op == OP_END:
+            texts.append(templates[op] % ip)
+        else:
+            texts.append(templates[op])
+    out.writelines(texts)
+
+# Top of stack caching
+# Straight-line code keeps the top of the stack in r12 and the value under it
+# in r13, cached says how many of them are live. Everything is spilled back to
+# memory before a jump or a label so every block starts and ends with the whole
+# stack in memory. dump only touches rax, rcx, rdx, rsi, rdi, r8, r9 and the
+# syscall r11, so calling it needs no spill.
+def compile_spill(out, cached):
+    if cached == 2:
+        out.write("    push r13\n")
+    if cached >= 1:
+        out.write("    push r12\n")
+    return 0
+
+# Gets at least count values into registers, gives back how many are cached now
+def compile_fill(out, cached, count):
+    if cached < count and cached == 1:
+        out.write("    pop  r13\n")
+        return 2
+    if cached < count and cached == 0:
+        out.write("    pop  r12\n")
+        if count == 2:
+            out.write("    pop  r13\n")
+            return 2
+        return 1
+    return cached
+
+# Room for one more value in r12, the old top moves to r13 and r13 to memory
+def compile_make_room(out, cached):
+    if cached == 2:
+        out.write("    push r13\n")
+    if cached >= 1:
+        out.write("    mov  r13, r12\n")
+        return 2
+    return 1
+
+def compile_ops_cached(out, program):
+    ops = program.ops
+    args = program.args
+    cached = 0
+    for ip in range(len(ops)):
+        op = ops[ip]
+        assert COUNT_OPS == 10, "Exhaustive handling of ops in compilation"
+        if op == OP_PUSH:
+            out.write("    ;; -- push --\n")
+            cached = compile_make_room(out, cached)
+            out.write("    mov  r12, %d\n" % args[ip])
+        elif op == OP_PLUS:
+            out.write("    ;; -- plus --\n")
+            cached = compile_fill(out, cached, 2)
+            out.write("    add  r12, r13\n")
+            cached = 1
+        elif op == OP_MINUS:
+            out.write("    ;; -- minus --\n")
+            cached = compile_fill(out, cached, 2)
+            out.write("    sub  r13, r12\n")
+            out.write("    mov  r12, r13\n")
+            cached = 1
+        elif op == OP_EQUAL or op == OP_GT:
+            out.write("    ;; -- %s --\n" % OP_NAMES[op])
+            cached = compile_fill(out, cached, 2)
+            out.write("    xor  eax, eax\n")
+            out.write("    cmp  r13, r12\n")
+            out.write("    %s al\n" % ("sete " if op == OP_EQUAL else "setg "))
+            out.write("    mov  r12, rax\n")
+            cached = 1
+        elif op == OP_DUMP:
+            out.write("    ;; -- dump --\n")
+            if cached == 0:
                 out.write("    pop  rdi\n")
-                out.write("    call dump\n") # Calls the dump function which calls write
-            elif op[0] == OP_IF:
-                out.write("    ;; -- if --\n")
-                out.write("    pop  rax\n") # Pop current value ontop of stack
-                out.write("    test rax, rax\n") # Check if equal to zero
-                assert len(op) == 2, "From compilation: 'if' instruction does not have a reference to the end of it's block. Call crossreference_blocks()."
-                out.write("    jz  addr_%d\n" % op[1]) # Jump to address available in op, if equal to zero
-            elif op[0] == OP_ELSE:
-                out.write("    ;; -- else --\n")
-                assert len(op) >= 2, "From compilation: 'else' instruction does not have a reference to the end of it's block. Call crossreference_blocks()."
-                out.write("     jmp  addr_%d\n" % op[1]) # Just jump to addr that sits in tuple
-                out.write("addr_%d:\n" % (ip + 1)) # Addr that follows if
-            elif op[0] == OP_END:
-                out.write("addr_%d:\n" % ip) # End to jump to, not indented
-            elif op[0] == OP_DUP:
-                out.write("    ;; -- dup --\n")
-                out.write("    pop  rax\n")
-                out.write("    push rax\n") # Pop and push twice, like in simulation
-                out.write("    push rax\n")
-            elif op[0] == OP_GT:
-                out.write("    ;; -- gt --\n")
-                out.write("    mov rcx, 0\n")
-                out.write("    mov rdx, 1\n")
-                out.write("    pop rbx\n") # Pop different order from equal, because number order matters here
-                out.write("    pop rax\n") # Mostly because how we add rcx and rdx in above order
-                out.write("    cmp rax, rbx\n")
-                out.write("    cmovg rcx, rdx\n")
-                out.write("    push rcx\n")
             else:
-                assert False, "unreachable"
-        out.write("    mov  rax, 60\n") # syscall for exit
-        out.write("    mov  rdi, 0\n")
-        out.write("    syscall\n")
+                out.write("    mov  rdi, r12\n")
+                if cached == 2:
+                    out.write("    mov  r12, r13\n")
+                cached -= 1
+            out.write("    call dump\n")
+        elif op == OP_IF:
+            out.write("    ;; -- if --\n")
+            cached = compile_fill(out, cached, 1)
+            out.write("    test r12, r12\n")
+            if cached == 2:
+                out.write("    push r13\n") # Doesn't touch the flags
+            cached = 0
+            assert args[ip] >= 0, "From compilation: 'if' instruction does not have a reference to the end of it's block. Call crossreference_blocks()."
+            out.write("    jz  addr_%d\n" % args[ip])
+        elif op == OP_ELSE:
+            out.write("    ;; -- else --\n")
+            cached = compile_spill(out, cached)
+            assert args[ip] >= 0, "From compilation: 'else' instruction does not have a reference to the end of it's block. Call crossreference_blocks()."
+            out.write("    jmp  addr_%d\n" % args[ip])
+            out.write("addr_%d:\n" % (ip + 1))
+        elif op == OP_END:
+            cached = compile_spill(out, cached)
+            out.write("addr_%d:\n" % ip)
+        elif op == OP_DUP:
+            out.write("    ;; -- dup --\n")
+            if cached == 0:
+                out.write("    pop  r12\n")
+                cached = 1
+            cached = compile_make_room(out, cached)
+        else:
+            assert False, "unreachable"
+
+# Peephole optimizer
+# Works on the generated assembly as a list of (mnemonic, operands, text)
+# records, mnemonic is None for anything that isn't code and ":" for labels.
+# Records keep the exact text they were written with, so the rewrites only
+# change the lines they replace.
+class AsmBuffer:
+    def __init__(self, records=None):
+        self.texts = [] if records is None else [text for (_, _, text) in records]
+        self.parsed = records
+        self.write = self.texts.append # Takes any number of whole lines
+        self.writelines = self.texts.extend
+
+    # Most texts and lines repeat over and over, each distinct one is parsed once
+    def records(self):
+        if self.parsed is not None:
+            return self.parsed
+        parsed = {}
+        lines = {}
+        records = []
+        for text in self.texts:
+            chunk = parsed.get(text)
+            if chunk is None:
+                chunk = parsed[text] = []
+                for line in text.splitlines(keepends=True):
+                    record = lines.get(line)
+                    if record is None:
+                        record = lines[line] = parse_asm_line(line)
+                    chunk.append(record)
+            records.extend(chunk)
+        return records
 
-# Call external programs and print a joined list
-def call_echoed(cmd):
-    print("[CMD] %s" % " ".join(map(shlex.quote, cmd)))
-    subprocess.call(cmd)
+# Labels and directives start at the beginning of the line, code is indented
+def parse_asm_line(text):
+    code = text.split(";", 1)[0] if ";" in text else text
+    if not code.startswith(" "):
+        code = code.strip()
+        if code.endswith(":") and " " not in code:
+            return (":", (code[:-1], ), text)
+        return (None, (), text)
+    (mnemonic, _, operands) = code.strip().partition(" ")
+    if not mnemonic:
+        return (None, (), text)
+    return (mnemonic, tuple(operand.strip() for operand in operands.split(",")) if operands else (), text)
+
+def asm(mnemonic, *operands):
+    return (mnemonic, operands, "    %-4s %s\n" % (mnemonic, ", ".join(operands)))
+
+ASM_REGISTERS = {
+    "rax": ("rax", "eax", "ax", "al"), "rbx": ("rbx", "ebx", "bx", "bl"),
+    "rcx": ("rcx", "ecx", "cx", "cl"), "rdx": ("rdx", "edx", "dx", "dl"),
+    "rsi": ("rsi", "esi", "si", "sil"), "rdi": ("rdi", "edi", "di", "dil"),
+}
+
+ASM_REGISTER_PATTERNS = {}
+
+# Whether any operand of the records mentions register (a 64 bit name) in any size
+def mentions(register, *records):
+    pattern = ASM_REGISTER_PATTERNS.get(register)
+    if pattern is None:
+        names = ASM_REGISTERS.get(register, (register, ))
+        pattern = ASM_REGISTER_PATTERNS[register] = re.compile(r"\b(%s)\b" % "|".join(names))
+    for (_, operands, _) in records:
+        for operand in operands:
+            if pattern.search(operand):
+                return True
+    return False
+
+def is_register(operand):
+    return operand in ASM_REGISTERS or re.fullmatch(r"r\d+", operand) is not None
+
+# push takes a sign extended 32 bit immediate and cuts anything wider, a mov
+# into a register would keep all 64 bits, so pushes of those stay as they are
+def is_wide_immediate(operand):
+    return re.fullmatch(r"-?\d+", operand) is not None and not fits_dword(int(operand))
+
+# Every rule takes consecutive instructions of one basic block and gives back
+# what they turn into or None when it doesn't apply. Registers other than
+# r12 and r13 never hold a value from one op to the next, and nothing reads
+# the stack below rsp.
+def peephole_push_pop(push, pop):
+    if push[0] != "push" or pop[0] != "pop":
+        return None
+    (source, ) = push[1]
+    (target, ) = pop[1]
+    if source == target:
+        return []
+    if "[" in source or is_wide_immediate(source):
+        return None
+    return [asm("mov", target, source)]
+
+def peephole_pop_push(pop, push):
+    if pop[0] != "pop" or push[0] != "push" or pop[1] != push[1] or not is_register(pop[1][0]):
+        return None
+    return [asm("mov", pop[1][0], "[rsp]")]
+
+# push a / mov x, b / pop y: the push only carried a past the mov
+def peephole_push_mov_pop(push, mov, pop):
+    if push[0] != "push" or mov[0] != "mov" or pop[0] != "pop" or "[" in push[1][0] or is_wide_immediate(push[1][0]):
+        return None
+    (target, ) = pop[1]
+    if not is_register(target) or target == mov[1][0] or mentions(target, mov) or mentions("rsp", mov):
+        return None
+    return [asm("mov", target, push[1][0]), mov]
+
+# Comparisons load 0 and 1 into rcx and rdx to cmov between them, setcc does it without rdx
+def peephole_compare(zero, one, first, second, cmp, cmov):
+    if (zero[:2] != ("mov", ("rcx", "0")) or one[:2] != ("mov", ("rdx", "1")) or cmp[0] != "cmp"
+            or not cmov[0].startswith("cmov") or cmov[1] != ("rcx", "rdx")
+            or mentions("rcx", first, second, cmp) or mentions("rdx", first, second, cmp)
+            or first[0] not in ("pop", "mov") or second[0] not in ("pop", "mov")):
+        return None
+    return [first, second, asm("xor", "ecx", "ecx"), cmp, asm("set" + cmov[0][len("cmov"):], "cl")]
+
+# (name, instructions, mnemonic the last one starts with, rule)
+PEEPHOLE_RULES = [
+    ("compare", 6, "cmov", peephole_compare),
+    ("push-mov-pop", 3, "pop", peephole_push_mov_pop),
+    ("push-pop", 2, "pop", peephole_push_pop),
+    ("pop-push", 2, "push", peephole_pop_push),
+]
+
+# Jumps, calls and labels end a basic block, rules never look across them
+def is_block_boundary(mnemonic):
+    return mnemonic == ":" or mnemonic.startswith("j") or mnemonic in ("call", "ret", "syscall")
+
+# The rules that could end at an instruction with this mnemonic, False if it ends the block
+def peephole_candidates(mnemonic):
+    if is_block_boundary(mnemonic):
+        return False
+    return [rule for rule in PEEPHOLE_RULES if mnemonic.startswith(rule[2])]
+
+# How many of the last instructions of a block the rules can still rewrite,
+# the ones before them are final
+PEEPHOLE_WINDOW = 8
+
+PEEPHOLE_CANDIDATES = {}
+
+# Appends records to result and rewrites them with PEEPHOLE_RULES as they come,
+# block holds the indices into result of the instructions in the window. A
+# rewrite sets what it replaces to None and feeds the new instructions back
+# in one by one, so the rules get tried again at every one of them and
+# nothing is left to match once all records are in.
+def peephole_feed(result, block, records, fired):
+    pending = list(reversed(records))
+    while pending:
+        record = pending.pop()
+        result.append(record)
+        mnemonic = record[0]
+        if mnemonic is None:
+            continue
+        rules = PEEPHOLE_CANDIDATES.get(mnemonic)
+        if rules is None:
+            rules = PEEPHOLE_CANDIDATES[mnemonic] = peephole_candidates(mnemonic)
+        if rules is False:
+            del block[:]
+            continue
+        block.append(len(result) - 1)
+        if len(block) > PEEPHOLE_WINDOW:
+            del block[0]
+        for (name, size, _, rule) in rules:
+            if len(block) < size:
+                continue
+            replacement = rule(*[result[i] for i in block[-size:]])
+            if replacement is None:
+                continue
+            fired[name] += 1
+            for i in block[-size:]:
+                result[i] = None
+            del block[-size:]
+            pending.extend(reversed(replacement))
+            break
+
+# Rewrites the code after _start with PEEPHOLE_RULES until none of them
+# applies anymore, gives back the new lines and how often each rule fired
+def peephole_optimize(lines):
+    fired = dict((name, 0) for (name, _, _, _) in PEEPHOLE_RULES)
+    start = next((i + 1 for i in range(len(lines)) if lines[i][:2] == (":", ("_start", ))), len(lines))
+    result = lines[:start]
+    peephole_feed(result, [], lines[start:], fired)
+    return ([record for record in result if record is not None], fired)
+
+PEEPHOLE_SLOT = re.compile(r"\{(\d+)\}")
+
+# The records of template with its numbers left as {first}, {first + 1}, ...
+def peephole_template_records(template, first):
+    text = template.replace("%d", "%s") % tuple("{%d}" % (first + i) for i in range(template.count("%d")))
+    return [parse_asm_line(line) for line in text.splitlines(keepends=True)]
+
+# Runs the rules over template after the window numbered state,
+# gives back [text, next state, the slots it keeps, how often each rule fired,
+# uses]. windows numbers every window met so far, states has them by number.
+# The text is everything that left the window, still to be formatted with
+# the values of the window and the numbers of the template. The next window numbers its
+# slots from 0 again in the order they show up, the kept slots say which
+# values those were.
+def peephole_template_step(state, template, windows, states):
+    (window, count) = states[state]
+    result = list(window)
+    block = [i for i in range(len(result)) if result[i][0] is not None]
+    fired = dict((name, 0) for (name, _, _, _) in PEEPHOLE_RULES)
+    peephole_feed(result, block, peephole_template_records(template, count), fired)
+    first = block[0] if block else len(result)
+    text = "".join(record[2] for record in result[:first] if record is not None)
+    kept = [record for record in result[first:] if record is not None]
+    slots = []
+    for record in kept:
+        for slot in PEEPHOLE_SLOT.findall(record[2]):
+            if int(slot) not in slots:
+                slots.append(int(slot))
+    renumber = lambda text: PEEPHOLE_SLOT.sub(lambda match: "{%d}" % slots.index(int(match.group(1))), text)
+    key = tuple((mnemonic, tuple(renumber(operand) for operand in operands), renumber(text)) for (mnemonic, operands, text) in kept)
+    following = windows.get(key)
+    if following is None:
+        following = windows[key] = len(states)
+        states.append((key, len(slots)))
+    return [text, following, slots, [fired[name] for (name, _, _, _) in PEEPHOLE_RULES], 0]
+
+# compile_ops with peephole_optimize over its output. The few templates come
+# again and again after the same few windows, so the rules run once for each
+# template after each window and the rewrite is cached. The numbers stay out
+# of it, the window has slots {0}, {1}, ... in their place and values holds
+# them. Pushes of values that don't fit in 32 bits can't be rewritten, their
+# rules look at the value so it is written into the template instead. Nothing
+# in the prologue after _start takes part in a rewrite, so the first window is
+# empty.
+def compile_ops_peephole(out, program):
+    ops = program.ops
+    args = program.args
+    windows = {(): 0}
+    states = [((), 0)]
+    steps = {}
+    state = 0
+    values = []
+    for ip in range(len(ops)):
+        op = ops[ip]
+        key = op
+        if op == OP_PUSH:
+            if fits_dword(args[ip]):
+                values.append(args[ip])
+            else:
+                key = COMPILED_OP_TEMPLATES[op] % args[ip]
+        elif op == OP_IF or op == OP_ELSE:
+            assert args[ip] >= 0, "From compilation: '%s' instruction does not have a reference to the end of it's block. Call crossreference_blocks()." % OP_NAMES[op]
+            values += (args[ip], ) if op == OP_IF else (args[ip], ip + 1)
+        elif op == OP_END:
+            values.append(ip)
+        step = steps.get((state, key))
+        if step is None:
+            template = key if isinstance(key, str) else COMPILED_OP_TEMPLATES[op]
+            step = steps[(state, key)] = peephole_template_step(state, template, windows, states)
+        step[4] += 1
+        if step[0]:
+            out.write(step[0].format(*values))
+        state = step[1]
+        values = [values[i] for i in step[2]]
+    out.write("".join(text for (_, _, text) in states[state][0]).format(*values))
+    fired = dict((name, 0) for (name, _, _, _) in PEEPHOLE_RULES)
+    for step in steps.values():
+        for (name, count) in zip(fired, step[3]):
+            fired[name] += count * step[4]
+    return fired
+
+# Gives back the whole assembly in an AsmBuffer and how often each peephole
+# rule fired, None with peephole=False
+def generate_assembly(program, tos_cache=False, peephole=True):
+    program = as_program(program)
+    if program.max_depth is None:
+        analyze_stack(program)
+    out = AsmBuffer()
+    out.write(COMPILED_PROLOGUE)
+    fired = None
+    if tos_cache:
+        compile_ops_cached(out, program)
+    elif peephole:
+        fired = compile_ops_peephole(out, program)
+    else:
+        compile_ops(out, program)
+    out.write(COMPILED_EPILOGUE % (program.max_depth + COMPILED_STACK_SLACK))
+    if peephole and tos_cache:
+        (lines, fired) = peephole_optimize(out.records())
+        out = AsmBuffer(lines)
+    return (out, fired)
+
+# Gives back how often each peephole rule fired, None with peephole=False
+def compile_program(program, out_file_path, tos_cache=False, peephole=True):
+    (out, fired) = generate_assembly(program, tos_cache, peephole)
+    with open(out_file_path, "w") as f:
+        f.write("".join(out.texts))
+    return fired
+
+# Assemble to a static ELF executable without nasm and ld
+# Encodes the instructions generate_assembly writes straight to x86-64 machine
+# code. Every jump, call and symbol address is encoded at full 32 bits, so the
+# size of an instruction never depends on where things end up and labels are
+# patched in one go once the layout is known.
+ELF_BASE_ADDRESS = 0x400000
+ELF_PAGE_SIZE = 0x1000
+ELF_HEADER_SIZE = 64
+ELF_PROGRAM_HEADER_SIZE = 56
+
+ELF_REGISTER_NAMES = {
+    64: ["rax", "rcx", "rdx", "rbx", "rsp", "rbp", "rsi", "rdi"] + ["r%d" % n for n in range(8, 16)],
+    32: ["eax", "ecx", "edx", "ebx", "esp", "ebp", "esi", "edi"] + ["r%dd" % n for n in range(8, 16)],
+    16: ["ax", "cx", "dx", "bx", "sp", "bp", "si", "di"] + ["r%dw" % n for n in range(8, 16)],
+    8: ["al", "cl", "dl", "bl", "spl", "bpl", "sil", "dil"] + ["r%db" % n for n in range(8, 16)],
+}
+ELF_REGISTERS = {name: (number, bits) for (bits, names) in ELF_REGISTER_NAMES.items() for (number, name) in enumerate(names)}
+ELF_SIZES = {"BYTE": 8, "WORD": 16, "DWORD": 32, "QWORD": 64}
+ELF_SCALES = {1: 0, 2: 1, 4: 2, 8: 3}
+
+# Condition codes of jcc, setcc and cmovcc
+ELF_CONDITIONS = {
+    "o": 0, "no": 1, "b": 2, "c": 2, "nae": 2, "ae": 3, "nb": 3, "nc": 3,
+    "e": 4, "z": 4, "ne": 5, "nz": 5, "be": 6, "na": 6, "a": 7, "nbe": 7,
+    "s": 8, "ns": 9, "p": 10, "np": 11, "l": 12, "nge": 12, "ge": 13, "nl": 13,
+    "le": 14, "ng": 14, "g": 15, "nle": 15,
+}
+ELF_ALU = {"add": 0, "or": 1, "and": 4, "sub": 5, "xor": 6, "cmp": 7}
+ELF_SHIFTS = {"shl": 4, "shr": 5, "sar": 7}
+ELF_UNARY = {"not": 2, "neg": 3, "mul": 4, "div": 6}
+ELF_PLAIN = {"ret": b"\xc3", "syscall": b"\x0f\x05"}
+
+# ("reg", number, bits), ("imm", value), ("sym", name) or
+# ("mem", bits, base, index, scale, disp, symbol), bits is None when the size is left to the other operand
+def parse_elf_operand(text):
+    if text in ELF_REGISTERS:
+        return ("reg", ) + ELF_REGISTERS[text]
+    bits = None
+    (size, _, rest) = text.partition(" ")
+    if size in ELF_SIZES:
+        (bits, text) = (ELF_SIZES[size], rest.strip())
+    if text.startswith("["):
+        (base, index, scale, disp, symbol) = (None, None, 1, 0, None)
+        for term in text[1:-1].replace(" ", "").replace("-", "+-").split("+"):
+            if "*" in term:
+                (name, factor) = term.split("*")
+                (index, scale) = (ELF_REGISTERS[name][0], int(factor))
+            elif term in ELF_REGISTERS:
+                if base is None:
+                    base = ELF_REGISTERS[term][0]
+                else:
+                    index = ELF_REGISTERS[term][0]
+            elif term.lstrip("-").isdecimal():
+                disp += int(term)
+            elif term:
+                symbol = term
+        assert index != 4, "rsp can't be an index register"
+        return ("mem", bits, base, index, scale, disp, symbol)
+    if text.lstrip("-").isdecimal():
+        return ("imm", int(text))
+    return ("sym", text)
+
+# Gives back (REX bits, ModRM and what follows it, offset of the 32 bit symbol displacement or None)
+def encode_modrm(reg, operand):
+    field = (reg & 7) << 3
+    rex = 4 if reg >= 8 else 0
+    if operand[0] == "reg":
+        number = operand[1]
+        return (rex | number >> 3, bytes([0xC0 | field | number & 7]), None)
+    (_, _, base, index, scale, disp, symbol) = operand
+    if index is not None:
+        rex |= (index >> 3) << 1
+    sib_index = (4 if index is None else index & 7) << 3 | ELF_SCALES[scale] << 6
+    if base is None: # Absolute address, a SIB byte without base register
+        return (rex, bytes([0x04 | field, sib_index | 5]) + struct.pack("<i", disp), None if symbol is None else 2)
+    rex |= base >> 3
+    if symbol is None and disp == 0 and base & 7 != 5:
+        (mod, displacement) = (0x00, b"")
+    elif symbol is None and -128 <= disp < 128:
+        (mod, displacement) = (0x40, struct.pack("<b", disp))
+    else:
+        (mod, displacement) = (0x80, struct.pack("<i", disp))
+    if index is None and base & 7 != 4:
+        head = bytes([mod | field | base & 7])
+    else:
+        head = bytes([mod | field | 4, sib_index | base & 7])
+    return (rex, head + displacement, None if symbol is None else len(head))
+
+# One instruction of opcode with a ModRM operand, gives back (code, fixups)
+def encode_rm(opcode, reg, operand, bits, immediate=b"", immediate_symbol=None):
+    (rex, modrm, offset) = encode_modrm(reg, operand)
+    if bits == 64:
+        rex |= 8
+    prefix = b"\x66" if bits == 16 else b""
+    # spl, bpl, sil and dil only exist with a REX prefix, without one they are ah, ch, dh and bh
+    if rex or (bits == 8 and (4 <= reg < 8 or operand[0] == "reg" and 4 <= operand[1] < 8)):
+        prefix += bytes([0x40 | rex])
+    head = len(prefix) + len(opcode)
+    fixups = []
+    if offset is not None:
+        fixups.append((head + offset, operand[6], False))
+    if immediate_symbol is not None:
+        fixups.append((head + len(modrm), immediate_symbol, False))
+    return (prefix + opcode + modrm + immediate, fixups)
+
+def encode_immediate(value, bits):
+    if bits == 8:
+        return struct.pack("<B", value & 0xFF)
+    if bits == 16:
+        return struct.pack("<H", value & 0xFFFF)
+    return struct.pack("<I", value & 0xFFFFFFFF) # Sign extended to 64 bits, larger values are cut like nasm does
+
+def fits_byte(value):
+    return -128 <= value < 128
+
+def fits_dword(value):
+    return -(1 << 31) <= value < (1 << 31)
+
+# Gives back (code, fixups), each fixup is (offset in code, symbol, relative)
+def encode_instruction(mnemonic, operands):
+    ops = [parse_elf_operand(operand) for operand in operands]
+    bits = next((op[2] for op in ops if op[0] == "reg"), None) or next((op[1] for op in ops if op[0] == "mem"), None)
+    if mnemonic in ELF_PLAIN and not ops:
+        return (ELF_PLAIN[mnemonic], [])
+    if mnemonic == "rep" and operands == ("movsb", ):
+        return (b"\xf3\xa4", [])
+    if len(ops) == 1 and ops[0][0] == "sym":
+        if mnemonic == "jmp":
+            opcode = b"\xe9"
+        elif mnemonic == "call":
+            opcode = b"\xe8"
+        elif mnemonic[0] == "j" and mnemonic[1:] in ELF_CONDITIONS:
+            opcode = bytes([0x0F, 0x80 | ELF_CONDITIONS[mnemonic[1:]]])
+        else:
+            opcode = None
+        if opcode is not None:
+            return (opcode + b"\0\0\0\0", [(len(opcode), ops[0][1], True)])
+    if mnemonic in ("push", "pop") and len(ops) == 1:
+        (kind, value) = ops[0][:2]
+        if kind == "reg" and ops[0][2] == 64:
+            code = bytes([(0x50 if mnemonic == "push" else 0x58) | value & 7])
+            return ((b"\x41" if value >= 8 else b"") + code, [])
+        if kind == "imm" and mnemonic == "push":
+            if fits_byte(value):
+                return (b"\x6a" + encode_immediate(value, 8), [])
+            return (b"\x68" + encode_immediate(value, 32), [])
+    if mnemonic in ELF_ALU and len(ops) == 2:
+        (target, source) = ops
+        alu = ELF_ALU[mnemonic]
+        if source[0] == "imm":
+            if bits == 8:
+                return encode_rm(b"\x80", alu, target, bits, encode_immediate(source[1], 8))
+            if fits_byte(source[1]):
+                return encode_rm(b"\x83", alu, target, bits, encode_immediate(source[1], 8))
+            return encode_rm(b"\x81", alu, target, bits, encode_immediate(source[1], min(bits, 32)))
+        if source[0] == "reg":
+            return encode_rm(bytes([alu << 3 | (0 if bits == 8 else 1)]), source[1], target, bits)
+        if target[0] == "reg":
+            return encode_rm(bytes([alu << 3 | (2 if bits == 8 else 3)]), target[1], source, bits)
+    if mnemonic == "test" and len(ops) == 2 and ops[1][0] == "reg":
+        return encode_rm(b"\x84" if bits == 8 else b"\x85", ops[1][1], ops[0], bits)
+    if mnemonic == "mov" and len(ops) == 2:
+        (target, source) = ops
+        if source[0] == "reg":
+            return encode_rm(b"\x88" if bits == 8 else b"\x89", source[1], target, bits)
+        if target[0] == "reg" and source[0] == "mem":
+            return encode_rm(b"\x8a" if bits == 8 else b"\x8b", target[1], source, bits)
+        if target[0] == "reg" and source[0] == "sym" and bits == 64:
+            return encode_rm(b"\xc7", 0, target, bits, b"\0\0\0\0", source[1])
+        if source[0] == "imm":
+            value = source[1]
+            if target[0] == "reg" and bits == 64 and not fits_dword(value):
+                number = target[1]
+                return (bytes([0x48 | number >> 3, 0xB8 | number & 7]) + struct.pack("<Q", value & 0xFFFFFFFFFFFFFFFF), [])
+            return encode_rm(b"\xc6" if bits == 8 else b"\xc7", 0, target, bits, encode_immediate(value, min(bits, 32)))
+    if mnemonic == "lea" and len(ops) == 2:
+        return encode_rm(b"\x8d", ops[0][1], ops[1], bits)
+    if mnemonic == "movzx" and len(ops) == 2 and ops[1][0] == "mem":
+        return encode_rm(b"\x0f\xb6" if ops[1][1] == 8 else b"\x0f\xb7", ops[0][1], ops[1], bits)
+    if mnemonic == "imul" and len(ops) == 3 and ops[2][0] == "imm":
+        if fits_byte(ops[2][1]):
+            return encode_rm(b"\x6b", ops[0][1], ops[1], bits, encode_immediate(ops[2][1], 8))
+        return encode_rm(b"\x69", ops[0][1], ops[1], bits, encode_immediate(ops[2][1], 32))
+    if mnemonic in ELF_UNARY and len(ops) == 1:
+        return encode_rm(b"\xf6" if bits == 8 else b"\xf7", ELF_UNARY[mnemonic], ops[0], bits)
+    if mnemonic in ELF_SHIFTS and len(ops) == 2 and ops[1][0] == "imm":
+        return encode_rm(b"\xc0" if bits == 8 else b"\xc1", ELF_SHIFTS[mnemonic], ops[0], bits, encode_immediate(ops[1][1], 8))
+    if mnemonic.startswith("set") and mnemonic[3:] in ELF_CONDITIONS and len(ops) == 1:
+        return encode_rm(bytes([0x0F, 0x90 | ELF_CONDITIONS[mnemonic[3:]]]), 0, ops[0], 8)
+    if mnemonic.startswith("cmov") and mnemonic[4:] in ELF_CONDITIONS and len(ops) == 2:
+        return encode_rm(bytes([0x0F, 0x40 | ELF_CONDITIONS[mnemonic[4:]]]), ops[0][1], ops[1], bits)
+    assert False, "The ELF backend can't encode %s %s" % (mnemonic, ", ".join(operands))
+
+# Lays out .text and .rodata in the first page onwards and .bss after them,
+# gives back the whole executable
+def link_elf(records):
+    sections = {".text": bytearray(), ".rodata": bytearray()}
+    bss_size = 0
+    symbols = {}
+    fixups = []
+    section = ".text"
+    scope = ""
+    def define(name, offset):
+        nonlocal scope
+        if name.startswith("."):
+            name = scope + name # nasm local labels belong to the label before them
+        else:
+            scope = name
+        symbols[name] = (section, offset)
+    encodings = {} # The same few instructions come up over and over
+    for (mnemonic, operands, text) in records:
+        if mnemonic == ":":
+            define(operands[0], bss_size if section == ".bss" else len(sections[section]))
+        elif mnemonic is not None:
+            code = sections[section]
+            encoding = encodings.get((mnemonic, operands))
+            if encoding is None:
+                encoding = encodings[(mnemonic, operands)] = encode_instruction(mnemonic, operands)
+            (encoded, encoded_fixups) = encoding
+            for (offset, symbol, relative) in encoded_fixups:
+                fixups.append((len(code) + offset, scope + symbol if symbol.startswith(".") else symbol, relative))
+            code += encoded
+        else:
+            words = text.split(";", 1)[0].split(None, 2)
+            if not words or words[0] in ("BITS", "global"):
+                continue
+            if words[0] == "segment":
+                section = words[1]
+            elif words[0].endswith(":") and words[1] == "db":
+                define(words[0][:-1], len(sections[section]))
+                data = words[2].strip()
+                sections[section] += data[1:-1].encode() if data.startswith('"') else bytes(int(value) for value in data.split(","))
+            elif words[0].endswith(":") and words[1] in ("resb", "resq"):
+                bss_size = -(-bss_size // 8) * 8 if words[1] == "resq" else bss_size
+                define(words[0][:-1], bss_size)
+                bss_size += int(words[2]) * (8 if words[1] == "resq" else 1)
+            else:
+                assert False, "The ELF backend can't handle %s" % text.strip()
+    text_address = ELF_BASE_ADDRESS + ELF_HEADER_SIZE + 2 * ELF_PROGRAM_HEADER_SIZE
+    rodata_address = -(-(text_address + len(sections[".text"])) // 8) * 8
+    file_end = rodata_address + len(sections[".rodata"])
+    bss_address = -(-file_end // ELF_PAGE_SIZE) * ELF_PAGE_SIZE
+    addresses = {".text": text_address, ".rodata": rodata_address, ".bss": bss_address}
+    code = sections[".text"]
+    for (offset, symbol, relative) in fixups:
+        (symbol_section, symbol_offset) = symbols[symbol]
+        target = addresses[symbol_section] + symbol_offset
+        if relative:
+            value = target - (text_address + offset + 4)
+        else:
+            value = struct.unpack_from("<i", code, offset)[0] + target
+        struct.pack_into("<i", code, offset, value)
+    header = struct.pack("<4sBBBBB7xHHIQQQIHHHHHH",
+        b"\x7fELF", 2, 1, 1, 0, 0, # 64 bit, little endian, System V
+        2, 0x3E, 1, # Executable for x86-64
+        addresses[symbols["_start"][0]] + symbols["_start"][1],
+        ELF_HEADER_SIZE, 0, 0, ELF_HEADER_SIZE, ELF_PROGRAM_HEADER_SIZE, 2, 0, 0, 0)
+    image_size = file_end - ELF_BASE_ADDRESS
+    # The headers, .text and .rodata are mapped read and execute, .bss is zeroed read and write memory
+    header += struct.pack("<IIQQQQQQ", 1, 5, 0, ELF_BASE_ADDRESS, ELF_BASE_ADDRESS, image_size, image_size, ELF_PAGE_SIZE)
+    header += struct.pack("<IIQQQQQQ", 1, 6, 0, bss_address, bss_address, 0, bss_size, ELF_PAGE_SIZE)
+    padding = bytes(rodata_address - text_address - len(code))
+    return header + code + padding + sections[".rodata"]
+
+# Same as compile_program, but writes an executable instead of assembly
+def assemble_program(program, out_file_path, tos_cache=False, peephole=True):
+    (out, fired) = generate_assembly(program, tos_cache, peephole)
+    with open(out_file_path, "wb") as f:
+        f.write(link_elf(out.records()))
+    os.chmod(out_file_path, 0o755)
+    return fired
+
+# Compile the program to C
+# Every value sits in the local array s at the depth analyze_stack would give
+# it, so all indices are constants and cc can keep the stack in registers.
+# if/else become C blocks, dump formats the same way as the assembly runtime.
+COMPILED_C_PROLOGUE = (
+    "#include <stdint.h>\n"
+    "#include <string.h>\n"
+    "#include <unistd.h>\n"
+    "\n"
+    "#define OUTPUT_SIZE (64 * 1024)\n"
+    "\n"
+    "static char output[OUTPUT_SIZE];\n"
+    "static size_t output_len;\n"
+    "\n"
+    "static void flush(void)\n"
+    "{\n"
+    "    size_t written = 0;\n"
+    "    while (written < output_len) {\n"
+    "        ssize_t n = write(1, output + written, output_len - written);\n"
+    "        if (n <= 0) break;\n"
+    "        written += n;\n"
+    "    }\n"
+    "    output_len = 0;\n"
+    "}\n"
+    "\n"
+    "static void dump(uint64_t value)\n"
+    "{\n"
+    "    char digits[20];\n"
+    "    size_t start = sizeof(digits);\n"
+    "    if (output_len > OUTPUT_SIZE - sizeof(digits) - 1) flush();\n"
+    "    do {\n"
+    "        digits[--start] = '0' + value % 10;\n"
+    "        value /= 10;\n"
+    "    } while (value);\n"
+    "    memcpy(output + output_len, digits + start, sizeof(digits) - start);\n"
+    "    output_len += sizeof(digits) - start;\n"
+    "    output[output_len++] = '\\n';\n"
+    "}\n"
+    "\n"
+    "int main(void)\n"
+    "{\n"
+)
+
+COMPILED_C_EPILOGUE = (
+    "    flush();\n"
+    "    return 0;\n"
+    "}\n"
+)
+
+def compile_program_c(program, out_file_path):
+    program = as_program(program)
+    if program.max_depth is None:
+        analyze_stack(program)
+    ops = program.ops
+    args = program.args
+    texts = [COMPILED_C_PROLOGUE, "    uint64_t s[%d];\n" % max(program.max_depth, 1)]
+    write = texts.append
+    assert COUNT_OPS == 10, "Exhaustive handling of ops in compile_program_c"
+    depth = 0
+    blocks = [] # Depth after the condition of every open if
+    indent = "    "
+    for ip in range(len(ops)):
+        op = ops[ip]
+        if op == OP_PUSH:
+            write("%ss[%d] = %dull;\n" % (indent, depth, args[ip] & 0xFFFFFFFFFFFFFFFF))
+        elif op == OP_PLUS:
+            write("%ss[%d] += s[%d];\n" % (indent, depth - 2, depth - 1))
+        elif op == OP_MINUS:
+            write("%ss[%d] -= s[%d];\n" % (indent, depth - 2, depth - 1))
+        elif op == OP_EQUAL:
+            write("%ss[%d] = s[%d] == s[%d];\n" % (indent, depth - 2, depth - 2, depth - 1))
+        elif op == OP_GT:
+            write("%ss[%d] = (int64_t)s[%d] > (int64_t)s[%d];\n" % (indent, depth - 2, depth - 2, depth - 1)) # Signed like cmovg
+        elif op == OP_DUMP:
+            write("%sdump(s[%d]);\n" % (indent, depth - 1))
+        elif op == OP_DUP:
+            write("%ss[%d] = s[%d];\n" % (indent, depth, depth - 1))
+        elif op == OP_IF:
+            write("%sif (s[%d]) {\n" % (indent, depth - 1))
+            blocks.append(depth - 1)
+            indent += "    "
+        elif op == OP_ELSE:
+            write("%s} else {\n" % indent[4:])
+            depth = blocks[-1]
+            continue
+        elif op == OP_END:
+            write("%s}\n" % indent[4:])
+            blocks.pop()
+            indent = indent[4:]
+            continue
+        else:
+            assert False, "%s can't be compiled" % op_name(op)
+        (pops, pushes) = STACK_EFFECTS[op]
+        depth += pushes - pops
+    write(COMPILED_C_EPILOGUE)
+    with open(out_file_path, "w") as f:
+        f.write("".join(texts))
+
+COM_BACKENDS = ("nasm", "elf", "c")
+
+# The generated source of the backends that run external tools, the commands
+# that build it and what they make
+BUILD_SOURCE_EXT = {"nasm": ".asm", "c": ".c"}
+BUILD_COMMANDS = {
+    "nasm": (["nasm", "-felf64", "{source}"], ["ld", "{obj}", "-o", "{exe}"]),
+    "c": (["cc", "-O2", "{source}", "-o", "{exe}"], ),
+}
+BUILD_OUTPUTS = {"nasm": ("{obj}", "{exe}"), "c": ("{exe}", )}
+
+def build_path(template, basename, backend):
+    return template.format(source=basename + BUILD_SOURCE_EXT[backend], obj=basename + ".o", exe=basename)
+
+def build_commands(basename, backend):
+    return [[build_path(word, basename, backend) for word in command] for command in BUILD_COMMANDS[backend]]
+
+# Build cache
+# The tools only ever see the generated source, so what they make is stored
+# under a hash of the source and the commands that build it. Every entry is a
+# directory with the outputs named after "program", the least recently used
+# entries are removed once the cache is over BUILD_CACHE_MAX_SIZE bytes.
+BUILD_CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+def build_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or path.join(path.expanduser("~"), ".cache")
+    return os.environ.get("PORTH_BUILD_CACHE") or path.join(cache_home, "porth", "build")
+
+# The tools are part of the key by where they are found, a different nasm, ld or cc builds anew
+def build_cache_key(source_path, backend):
+    toolchain = [(command, shutil.which(command[0])) for command in BUILD_COMMANDS[backend]]
+    key = hashlib.sha256(repr(toolchain).encode() + b"\0")
+    with open(source_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            key.update(chunk)
+    return key.hexdigest()
+
+def load_build_cache(cache_dir, key, basename, backend):
+    entry = path.join(cache_dir, key)
+    try:
+        for output in BUILD_OUTPUTS[backend]:
+            shutil.copy(path.join(entry, build_path(output, "program", backend)), build_path(output, basename, backend)) # Keeps the executable bit
+        os.utime(entry) # Marks it as used for the eviction
+    except OSError:
+        return False
+    return True
+
+def save_build_cache(cache_dir, key, basename, backend):
+    entry = path.join(cache_dir, key)
+    tmp_entry = "%s.%d.tmp" % (entry, os.getpid())
+    try:
+        os.makedirs(tmp_entry, exist_ok=True)
+        for output in BUILD_OUTPUTS[backend]:
+            shutil.copy(build_path(output, basename, backend), path.join(tmp_entry, build_path(output, "program", backend)))
+        os.replace(tmp_entry, entry)
+    except OSError:
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        return False # Cache is best effort like the .porthc, a full disk is not an error
+    evict_build_cache(cache_dir, BUILD_CACHE_MAX_SIZE)
+    return True
+
+def evict_build_cache(cache_dir, max_size):
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = path.join(cache_dir, name)
+        if name.endswith(".tmp"):
+            continue # Being written by some other com right now
+        try:
+            size = sum(path.getsize(path.join(entry, file_name)) for file_name in os.listdir(entry))
+            entries.append((path.getmtime(entry), size, entry))
+        except OSError:
+            continue
+    total = sum(size for (_, size, _) in entries)
+    for (_, size, entry) in sorted(entries):
+        if total <= max_size:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+# Compiling programs
+# com runs the code generation of every file in a process pool, each file goes
+# on to its tools in a thread as soon as its source is written. Both pools
+# have `jobs` workers, so the tools of one file overlap with code generation
+# of the next. Everything a file prints is collected and printed in one piece
+# once the file is done, with its path in front of every line when there are
+# several files.
+
+def com_basename(program_path):
+    porth_ext = '.porth'
+    basename = path.basename(program_path)
+    if basename.endswith(porth_ext):
+        basename = basename[:-len(porth_ext)]
+    return basename
+
+# Gives back (what was printed, whether it worked, seconds), runs in a worker when there are several files
+def generate_for_com(program_path, out_base, use_cache=True, fold=False, tos_cache=False, peephole=True, backend="nasm"):
+    start = time.perf_counter()
+    captured = io.StringIO()
+    ok = True
+    with contextlib.redirect_stdout(captured), contextlib.redirect_stderr(captured):
+        try:
+            program = load_program(program_path, use_cache)
+            analyze_stack(program)
+            if fold:
+                (folded, stats) = fold_program(program)
+                print("[INFO] Folded %d ops and %d constant if(s), %d ops left of %d" % (stats["folded"], stats["branches"], len(folded), len(program)))
+                program = folded
+                analyze_stack(program)
+            if backend == "elf":
+                print("[INFO] Generating %s" % out_base)
+                fired = assemble_program(program, out_base, tos_cache, peephole)
+            elif backend == "c":
+                print("[INFO] Generating %s" % (out_base + ".c"))
+                compile_program_c(program, out_base + ".c")
+                fired = None
+            else:
+                print("[INFO] Generating %s" % (out_base + ".asm"))
+                fired = compile_program(program, out_base + ".asm", tos_cache, peephole)
+            if fired is not None:
+                print("[INFO] Peephole rules fired %d time(s): %s" % (sum(fired.values()), ", ".join("%s %d" % (name, fired[name]) for name in fired)))
+        except SystemExit as error: # Errors in the program print their location and exit
+            ok = error.code in (None, 0)
+        except OSError as error: # Files that can't be read or written are not the compiler's fault
+            print("Error: %s" % error)
+            ok = False
+        except Exception: # A bug in the compiler fails this file, not the whole com
+            print("Error: The compiler crashed on %s" % program_path)
+            traceback.print_exc()
+            ok = False
+    return (captured.getvalue(), ok, time.perf_counter() - start)
+
+# Gives back (lines printed, whether it worked, seconds per phase)
+def build_for_com(generate, program_path, out_base, options):
+    backend = options["backend"]
+    timings = {}
+    (output, ok, timings["codegen"]) = generate(program_path, out_base, **options)
+    lines = output.splitlines()
+    if not ok or backend not in BUILD_COMMANDS:
+        return (lines, ok, timings)
+    cache_dir = build_cache_dir()
+    key = build_cache_key(build_path("{source}", out_base, backend), backend) if options["use_cache"] else None
+    if key is not None and load_build_cache(cache_dir, key, out_base, backend):
+        outputs = [build_path(output, out_base, backend) for output in BUILD_OUTPUTS[backend]]
+        lines.append("[INFO] Reused %s from the build cache in %s" % (" and ".join(outputs), cache_dir))
+        return (lines, ok, timings)
+    for cmd in build_commands(out_base, backend):
+        lines.append("[CMD] %s" % " ".join(map(shlex.quote, cmd)))
+        (result, timings[cmd[0]]) = run_timed(cmd)
+        lines.extend(result.stdout.decode(errors="replace").splitlines())
+        if result.returncode != 0:
+            lines.append("Error: %s exited with code %d" % (cmd[0], result.returncode))
+            return (lines, False, timings)
+    if key is not None:
+        save_build_cache(cache_dir, key, out_base, backend)
+    return (lines, ok, timings)
+
+def com_programs(program_paths, out_dir=None, jobs=None, **options):
+    out_bases = {}
+    for program_path in program_paths:
+        out_base = com_basename(program_path) if out_dir is None else path.join(out_dir, com_basename(program_path))
+        if out_base in out_bases:
+            print("Error: %s and %s would both be compiled to %s" % (out_bases[out_base], program_path, out_base))
+            exit(1)
+        out_bases[out_base] = program_path
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+    if len(program_paths) == 1: # Nothing to overlap, skip the pools
+        (lines, ok, _) = build_for_com(generate_for_com, program_paths[0], next(iter(out_bases)), options)
+        print("\n".join(lines))
+        return ok
+    jobs = min(jobs or os.cpu_count() or 1, len(program_paths))
+    totals = {}
+    failed = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as processes, ThreadPoolExecutor(max_workers=jobs) as threads:
+        # Queued from here before any thread runs, the workers are not forked off a threaded process
+        generated = {out_base: processes.submit(generate_for_com, program_path, out_base, **options) for (out_base, program_path) in out_bases.items()}
+        generate = lambda program_path, out_base, **options: generated[out_base].result()
+        builds = {threads.submit(build_for_com, generate, program_path, out_base, options): program_path for (out_base, program_path) in out_bases.items()}
+        for build in as_completed(builds):
+            (lines, ok, timings) = build.result()
+            for line in lines:
+                print("%s: %s" % (builds[build], line))
+            for phase in timings:
+                totals[phase] = totals.get(phase, 0.0) + timings[phase]
+            failed += not ok
+    elapsed = time.perf_counter() - start
+    print("[INFO] Compiled %d of %d program(s) in %.3fs with %d job(s), time spent in %s" % (len(program_paths) - failed, len(program_paths), elapsed, jobs, ", ".join("%s %.3fs" % (phase, totals[phase]) for phase in totals)))
+    return failed == 0
+
+# Test runner
+# Every program is simulated and compiled from a worker thread, the compiled
+# binary has to print the same as the simulation and the simulation has to
+# match the expectation recorded next to the program in <file>.txt. Workers
+# only wait on subprocesses so threads are enough to run all files side by side.
+TEST_EXPECTATION_EXT = ".txt"
+
+def test_expectation_path(file_path):
+    return path.splitext(file_path)[0] + TEST_EXPECTATION_EXT
+
+# :returncode <code>
+# :stdout <size>
+# <stdout bytes>
+def save_test_expectation(file_path, returncode, stdout):
+    with open(test_expectation_path(file_path), "wb") as f:
+        f.write(b":returncode %d\n:stdout %d\n" % (returncode, len(stdout)))
+        f.write(stdout)
+
+def load_test_expectation(file_path):
+    expectation_path = test_expectation_path(file_path)
+    if not path.exists(expectation_path):
+        return None
+    with open(expectation_path, "rb") as f:
+        returncode = f.readline()
+        size = f.readline()
+        stdout = f.read()
+    try:
+        assert returncode.startswith(b":returncode ") and size.startswith(b":stdout ")
+        (returncode, size) = (int(returncode[len(b":returncode "):]), int(size[len(b":stdout "):]))
+        assert len(stdout) == size
+    except (AssertionError, ValueError):
+        print("Error: %s is not an expectation recorded by --record" % expectation_path)
+        exit(1)
+    return (returncode, stdout)
+
+def discover_tests(paths):
+    files = []
+    for test_path in paths:
+        if path.isdir(test_path):
+            files.extend(sorted(path.join(test_path, name) for name in os.listdir(test_path) if name.endswith(".porth")))
+        else:
+            files.append(test_path)
+    return files
+
+def run_timed(cmd, cwd=None):
+    start = time.perf_counter()
+    result = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return (result, time.perf_counter() - start)
+
+# Runs in a worker, gives back (returncode, stdout) of sim, of com if it
+# failed and of the binary if it didn't, None otherwise, and the timings
+def run_test(file_path, flags):
+    compiler_path = path.abspath(__file__)
+    file_dir = path.dirname(file_path) or "."
+    # From the program's directory so errors name the file the same way wherever the runner is
+    (sim, sim_time) = run_timed([sys.executable, compiler_path, "sim", *flags, path.basename(file_path)], file_dir)
+    with tempfile.TemporaryDirectory() as build_dir:
+        (com, com_time) = run_timed([sys.executable, compiler_path, "com", *flags, path.abspath(file_path)], build_dir)
+        binary_path = path.join(build_dir, path.splitext(path.basename(file_path))[0])
+        if com.returncode != 0 or not path.exists(binary_path):
+            return ((sim.returncode, sim.stdout), (com.returncode, com.stdout), None, (sim_time, com_time, 0.0))
+        (binary, run_time) = run_timed([binary_path], build_dir)
+    return ((sim.returncode, sim.stdout), None, (binary.returncode, binary.stdout), (sim_time, com_time, run_time))
+
+def describe_output(returncode, stdout):
+    lines = stdout.decode(errors="replace").splitlines()
+    shown = "\n".join("        " + line for line in lines[:10])
+    if len(lines) > 10:
+        shown += "\n        ... %d more line(s)" % (len(lines) - 10)
+    return "exit code %d:\n%s" % (returncode, shown) if lines else "exit code %d and no output" % returncode
+
+def test_programs(paths, record=False, flags=()):
+    files = discover_tests(paths)
+    if not files:
+        print("Error: No programs to test in %s" % ", ".join(paths))
+        exit(1)
+    workers = min(os.cpu_count() or 1, len(files))
+    failed = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(run_test, files, [list(flags)] * len(files))
+        for (file_path, (sim, com_error, binary, timings)) in zip(files, results):
+            problems = []
+            notes = []
+            if record:
+                save_test_expectation(file_path, *sim)
+                notes.append("recorded %s" % test_expectation_path(file_path))
+            else:
+                expected = load_test_expectation(file_path)
+                if expected is None:
+                    notes.append("no expectation in %s, only sim and com were compared" % test_expectation_path(file_path))
+                elif expected != sim:
+                    problems.append("sim differs from the expectation\n    expected %s\n    actual %s" % (describe_output(*expected), describe_output(*sim)))
+            if sim[0] == 0 and com_error is not None:
+                problems.append("com failed with %s" % describe_output(*com_error))
+            elif sim[0] != 0 and com_error is None:
+                problems.append("com succeeded but sim failed with %s" % describe_output(*sim))
+            elif binary is not None and binary != sim:
+                problems.append("compiled program differs from sim\n    sim %s\n    com %s" % (describe_output(*sim), describe_output(*binary)))
+            status = "FAIL" if problems else "OK"
+            print("[%s] %s  sim %.3fs  com %.3fs  run %.3fs" % ((status, file_path) + timings))
+            for line in problems + notes:
+                print("    " + line)
+            failed += bool(problems)
+    elapsed = time.perf_counter() - start
+    print("[INFO] %d passed, %d failed in %.3fs with %d worker(s)" % (len(files) - failed, failed, elapsed, workers))
+    return failed == 0
 
 # Print usage information
 def usage(compiler_name):
     print("Usage: %s <subcommand> [args]" % compiler_name)
-    print("     sim <file>        Simulate the program")
-    print("     com <file>        Compile the program")
-    print("     help              Print this help to stdout and exit with 0 code")
+    print("     sim [options] <file>  Simulate the program")
+    print("     com [options] <files> Compile the programs")
+    print("     test [options] [paths] Simulate and compile every program in paths in parallel and check the")
+    print("                           output against <file>.txt (default: the examples directory)")
+    print("     help                  Print this help to stdout and exit with 0 code")
+    print("Options:")
+    print("     --no-cache            Don't read or write the <file>.porthc program cache, nor the com build cache")
+    print("                           in $PORTH_BUILD_CACHE (default: ~/.cache/porth/build)")
+    print("     --engine=<name>       Simulator engine: %s (default: ladder)" % ", ".join(SIM_ENGINES))
+    print("     --fuse                Fuse common op sequences into single ops before simulating")
+    print("     --fuse-stats          Same as --fuse and report how many of each fused op were made to stderr")
+    print("     --jit                 Translate the program to Python before simulating, falls back to the engine")
+    print("     --batch <seeds.csv>   Simulate one lane per row of seeds with NumPy, the header names the")
+    print("                           literals to replace by <row>:<col> and the output is grouped by lane")
+    print("     --profile[=<file>]    Count and time every op on the closure engine, print the hottest to stderr and")
+    print("                           save collapsed stacks for flame graphs to <file> (default: <program>.folded)")
+    print("     --trace=<n>           Keep the last <n> executed ops on the closure engine and print them to stderr")
+    print("                           when the program fails or the process gets SIGUSR1")
+    print("     --fold                Evaluate constant arithmetic and constant if conditions before running or compiling")
+    print("     --tos-cache           com: keep the top two stack values in registers within straight-line code")
+    print("     --no-peephole         com: write the generated assembly as is, without peephole rewrites")
+    print("     --backend=<name>      com: nasm writes <file>.asm and builds it with nasm and ld, elf writes the")
+    print("                           executable itself, c writes <file>.c and builds it with cc -O2 (default: nasm)")
+    print("     -o <dir>              com: write the assembly, objects and executables to <dir> (default: .)")
+    print("     -j <n>                com: generate code for up to <n> files at once and run nasm and ld for up")
+    print("                           to <n> files at once (default: the number of CPUs)")
+    print("     --record              test: save the simulation output as the new <file>.txt expectations")
 
+# Keyword to op constructor, everything else has to be an integer literal
+KEYWORDS = {
+    '+': plus,
+    '-': minus,
+    '.': dump,
+    '=': equal,
+    'if': iff,
+    'end': end,
+    'else': elze,
+    'dup': dup,
+    '>': gt,
+}
+assert COUNT_OPS == 10, "Exhaustive op handling in KEYWORDS"
+
+def parse_word_as_op(word):
+    if word.isdecimal():
+        return push(int(word)) # Plain literals are the common case, skip the keyword lookup
+    make_op = KEYWORDS.get(word)
+    if make_op is not None:
+        return make_op()
+    return push(int(word)) # Signed literals and such, throws ValueError if it can't parse
+
+# Same as parse_word_as_op, inlined since this runs once per token
 def parse_token_as_op(token):
-    (file_path, row, col, word) = token # Destructuring an enumeration?
-    assert COUNT_OPS == 10, "Exhaustive op handling in parse_token_as_op"
-    if word == '+':
-        return plus()
-    elif word == '-':
-        return minus()
-    elif word == '.':
-        return dump()
-    elif word == '=':
-        return equal()
-    elif word == 'if':
-        return iff()
-    elif word == 'end':
-        return end()
-    elif word == 'else':
-        return elze()
-    elif word == 'dup':
-        return dup()
-    elif word == '>':
-        return gt()
-    else:
+    word = token[3]
+    if word.isdecimal():
+        return (OP_PUSH, int(word))
+    make_op = KEYWORDS.get(word)
+    if make_op is not None:
+        return make_op()
+    try:
+        return push(int(word))
+    except ValueError as err:
+        (file_path, row, col, word) = token # Destructuring an enumeration?
+        print("%s:%d:%d: %s" % (file_path, row, col, err)) 
+        exit(1)
+
+# Parses a whole TokenStore at once. Every distinct word is parsed only once
+# and the ops are shared by all tokens that use that word.
+def parse_tokens(store):
+    ops = []
+    for word in store.words:
         try:
-            return push(int(word)) # Throws automatic error if can't parse.
+            ops.append(parse_word_as_op(word))
         except ValueError as err:
-            print("%s:%d:%d: %s" % (file_path, row, col, err)) 
-            exit(1)
+            ops.append(err)
+    bad_words = [word_id for word_id in range(len(ops)) if isinstance(ops[word_id], ValueError)]
+    if bad_words:
+        # Report the first bad token in the source, like parse_token_as_op would
+        ip = min(store.word_ids.index(word_id) for word_id in bad_words)
+        print("%s: %s" % (store.loc(ip), ops[store.word_ids[ip]]))
+        exit(1)
+    return [ops[word_id] for word_id in store.word_ids]
 
 # Handling blocks
+# Resolves the op at `ip` against the stack of open blocks, so blocks can be
+# crossreferenced while the program is still being parsed. Jump targets are
+# patched in place in the args column.
+def crossreference_op(program, stack, ip):
+    ops = program.ops
+    op = ops[ip]
+    assert COUNT_OPS == 10, "Exhaustive handling of ops in crossreference_op."
+                           # Keep in mind that not all of the ops needs to be handled
+                           # here, just the ones that form blocks.
+    if op == OP_IF:
+        stack.append(ip) # Current address to stack
+    elif op == OP_ELSE:
+        if not stack or ops[stack[-1]] != OP_IF:
+            stack_error(program, ip, "'else' can only be used in if blocks")
+        if_ip = stack.pop()
+        program.args[if_ip] = ip + 1 # Current address, just like at end, +1 to skip else instruction itself so that we execute the else block because otherwise else just jumps to end
+        stack.append(ip) # Keep track of the new block that just formed starting address
+    elif op == OP_END:
+        if not stack:
+            stack_error(program, ip, "'end' has no block to close")
+        block_ip = stack.pop() # Pop that address # Rewriting to cover whiles and such
+        if ops[block_ip] == OP_IF or ops[block_ip] == OP_ELSE:
+            program.args[block_ip] = ip
+        else:
+            stack_error(program, ip, "'end' can only close if-else blocks for now")
+
 def crossreference_blocks(program):
+    program = as_program(program)
     stack = []
     for ip in range(len(program)):
-        op = program[ip]
-        assert COUNT_OPS == 10, "Exhaustive handling of ops in crossreference_blocks."
-                               # Keep in mind that not all of the ops needs to be handled
-                               # here, just the ones that form blocks.
-        if op[0] == OP_IF:
-            stack.append(ip) # Current address to stack
-        elif op[0] == OP_ELSE:
-            if_ip = stack.pop()
-            assert program[if_ip][0] == OP_IF, "'else' can only be used in if blocks"
-            program[if_ip] = (OP_IF, ip + 1) # Current address, just like at end, +1 to skip else instruction itself so that we execute the else block because otherwise else just jumps to end
-            stack.append(ip) # Keep track of the new block that just formed starting address
-        elif op[0] == OP_END:
-            block_ip = stack.pop() # Pop that address # Rewriting to cover whiles and such
-            if program[block_ip][0] == OP_IF or program[block_ip][0] == OP_ELSE:
-                program[block_ip] = (program[block_ip][0], ip) # Set to right tuple
-            else:
-                assert False, "'end' can only close if-else blocks for now."
+        crossreference_op(program, stack, ip)
     return program
 
 # Lexer functions
-def find_col(line, start, predicate):
-    while start < len(line) and not predicate(line[start]):
-        start += 1
-    return start
-
-def lex_line(line):
-    col = find_col(line, 0, lambda x: not x.isspace()) # Advance until no space found
-    while col < len(line):
-        col_end = find_col(line, col, lambda x: x.isspace()) # Advance until space found
-        yield (col, line[col:col_end]) # Partial return, interesting
-        col = find_col(line, col_end, lambda x: not x.isspace()) # Keep advancing until next space
+# One regex over the whole source: every match is either a word or a newline,
+# newlines only move the row counter and the start of the current line.
+TOKEN_REGEX = re.compile(r"\S+|\n")
+
+# Size of the pieces lex_file reads at a time, cut back to the last newline
+LEX_CHUNK_SIZE = 1 << 20
+
+def lex_source(file_path, source, row=0):
+    line_start = 0
+    for match in TOKEN_REGEX.finditer(source):
+        word = match.group()
+        if word == "\n":
+            row += 1
+            line_start = match.end()
+        else:
+            yield (file_path, row, match.start() - line_start, word)
 
+# Generates tokens while reading, only one chunk of the file is held at a time
 def lex_file(file_path):
     with open(file_path, "r") as f:
-        return [(file_path, row, col, token)
-                for (row, line) in enumerate(f.readlines())
-                for (col, token) in lex_line(line)]
+        row = 0
+        rest = ""
+        while True:
+            chunk = f.read(LEX_CHUNK_SIZE)
+            if not chunk:
+                break
+            cut = chunk.rfind("\n") + 1
+            if cut == 0:
+                rest += chunk # No complete line yet
+                continue
+            source = rest + chunk[:cut]
+            rest = chunk[cut:]
+            yield from lex_source(file_path, source, row)
+            row += source.count("\n")
+        yield from lex_source(file_path, rest, row)
+
+# Struct of arrays alternative to a list of token tuples. File paths and words
+# are interned into tables and every token is just four ints in array columns.
+class TokenStore:
+    def __init__(self):
+        self.files = []
+        self.file_index = {}
+        self.words = []
+        self.word_index = {}
+        self.file_ids = array("i")
+        self.rows = array("i")
+        self.cols = array("i")
+        self.word_ids = array("i")
+
+    def intern_file(self, file_path):
+        file_id = self.file_index.get(file_path)
+        if file_id is None:
+            file_id = self.file_index[file_path] = len(self.files)
+            self.files.append(file_path)
+        return file_id
+
+    def intern_word(self, word):
+        word_id = self.word_index.get(word)
+        if word_id is None:
+            word_id = self.word_index[word] = len(self.words)
+            self.words.append(word)
+        return word_id
+
+    def append(self, token):
+        (file_path, row, col, word) = token
+        self.file_ids.append(self.intern_file(file_path))
+        self.rows.append(row)
+        self.cols.append(col)
+        self.word_ids.append(self.intern_word(word))
+
+    def extend(self, tokens):
+        for token in tokens:
+            self.append(token)
+
+    def __len__(self):
+        return len(self.word_ids)
+
+    # Gives back the usual (file_path, row, col, word) tuple, so it can be fed to parse_token_as_op
+    def __getitem__(self, i):
+        return (self.files[self.file_ids[i]], self.rows[i], self.cols[i], self.words[self.word_ids[i]])
+
+    def loc(self, i):
+        return "%s:%d:%d" % (self.files[self.file_ids[i]], self.rows[i], self.cols[i])
+
+def lex_file_to_store(file_path, store=None):
+    if store is None:
+        store = TokenStore()
+    store.extend(lex_file(file_path))
+    return store
 
 # Load source code
+# Tokens go straight from the file into the parser and the block resolver,
+# so only the op list and the stack of open blocks are ever kept around.
 def load_program_from_file(file_path):
-    return crossreference_blocks([parse_token_as_op(token) for token in lex_file(file_path)])
-    
+    program = Program()
+    stack = []
+    for token in lex_file(file_path):
+        try:
+            program.append(parse_token_as_op(token), token)
+        except OverflowError:
+            (file_path, row, col, word) = token
+            print("%s:%d:%d: integer literal %s does not fit in 64 bits" % (file_path, row, col, word))
+            exit(1)
+        crossreference_op(program, stack, len(program) - 1)
+    return program
+
+# Compiled program cache
+# The crossreferenced program is stored next to the source as <name>.porthc.
+# The header holds a hash of the source and of everything in the compiler
+# that decides which ops come out of it, any change there makes the cache stale.
+PORTHC_MAGIC = b"PORTHC"
+PORTHC_VERSION = 2
+PORTHC_HEADER_SIZE = len(PORTHC_MAGIC) + 32 + 8
+
+def compiler_fingerprint():
+    assert COUNT_OPS == 10, "Exhaustive handling of ops in compiler_fingerprint"
+    keywords = sorted((word, make_op()[0]) for (word, make_op) in KEYWORDS.items())
+    return repr((PORTHC_VERSION, COUNT_OPS, OP_NAMES, keywords)).encode()
+
+def porthc_path(file_path):
+    return path.splitext(file_path)[0] + ".porthc"
+
+def porthc_key(source):
+    return hashlib.sha256(compiler_fingerprint() + b"\0" + source).digest()
+
+# The columns of the Program are written as they are. Locations are only
+# rows and cols, a program comes from a single file so the path is whatever
+# the program is loaded as next time.
+def save_program_cache(program, cache_path, key):
+    tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(PORTHC_MAGIC + key + len(program).to_bytes(8, "little"))
+            program.ops.tofile(f)
+            program.args.tofile(f)
+            program.rows.tofile(f)
+            program.cols.tofile(f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        return False # Cache is best effort, a read-only directory is not an error
+    return True
+
+def load_program_cache(cache_path, key, file_path):
+    program = Program()
+    try:
+        with open(cache_path, "rb") as f:
+            header = f.read(PORTHC_HEADER_SIZE)
+            if len(header) != PORTHC_HEADER_SIZE or header[:len(PORTHC_MAGIC)] != PORTHC_MAGIC or header[len(PORTHC_MAGIC):-8] != key:
+                return None
+            count = int.from_bytes(header[-8:], "little")
+            program.ops.fromfile(f, count)
+            program.args.fromfile(f, count)
+            program.rows.fromfile(f, count)
+            program.cols.fromfile(f, count)
+    except (OSError, EOFError):
+        return None
+    program.files.append(file_path)
+    program.file_index[file_path] = 0
+    program.file_ids = array("i", bytes(program.file_ids.itemsize * count))
+    return program
+
+def load_program(file_path, use_cache=True):
+    cache_path = porthc_path(file_path)
+    if not use_cache or cache_path == file_path: # Never write the cache over its own source
+        return load_program_from_file(file_path)
+    with open(file_path, "rb") as f:
+        key = porthc_key(f.read())
+    program = load_program_cache(cache_path, key, file_path)
+    if program is None:
+        program = load_program_from_file(file_path)
+        save_program_cache(program, cache_path, key)
+    return program
+
 if __name__ == '__main__':
     argv = sys.argv
 
@@ -339,29 +2653,138 @@ if __name__ == '__main__':
     # Parse rest
     subcommand, *argv = argv # extract subcommand
 
+    use_cache = True
+    engine = "ladder"
+    jit = False
+    fuse = False
+    fuse_stats = False
+    batch_path = None
+    record = False
+    profile_path = None
+    trace_size = None
+    tos_cache = False
+    peephole = True
+    fold = False
+    backend = "nasm"
+    out_dir = None
+    jobs = None
+    while len(argv) > 0 and argv[0].startswith("-"):
+        flag, *argv = argv
+        if flag == "--no-cache":
+            use_cache = False
+        elif flag.startswith("--engine="):
+            engine = flag[len("--engine="):]
+            if engine not in SIM_ENGINES:
+                print("Error: Unknown simulator engine %s" % engine)
+                usage(compiler_name)
+                exit(1)
+        elif flag == "--jit":
+            jit = True
+        elif flag == "--fuse":
+            fuse = True
+        elif flag == "--fuse-stats":
+            fuse = True
+            fuse_stats = True
+        elif flag == "--batch":
+            if len(argv) < 1:
+                print("Error: --batch needs a seeds file")
+                usage(compiler_name)
+                exit(1)
+            batch_path, *argv = argv
+        elif flag == "--record":
+            record = True
+        elif flag == "--profile":
+            profile_path = "" # Named after the program once we know it
+        elif flag.startswith("--profile="):
+            profile_path = flag[len("--profile="):]
+        elif flag == "--tos-cache":
+            tos_cache = True
+        elif flag == "--no-peephole":
+            peephole = False
+        elif flag == "--fold":
+            fold = True
+        elif flag == "-o":
+            if len(argv) < 1:
+                print("Error: -o needs an output directory")
+                usage(compiler_name)
+                exit(1)
+            out_dir, *argv = argv
+        elif flag == "-j":
+            if len(argv) < 1 or not argv[0].isdecimal() or int(argv[0]) < 1:
+                print("Error: -j needs a positive number of jobs")
+                usage(compiler_name)
+                exit(1)
+            jobs, *argv = argv
+            jobs = int(jobs)
+        elif flag.startswith("--backend="):
+            backend = flag[len("--backend="):]
+            if backend not in COM_BACKENDS:
+                print("Error: Unknown compiler backend %s" % backend)
+                usage(compiler_name)
+                exit(1)
+        elif flag.startswith("--trace="):
+            trace_size = flag[len("--trace="):]
+            if not trace_size.isdecimal() or int(trace_size) < 1:
+                print("Error: --trace needs a positive number of ops, got %s" % trace_size)
+                usage(compiler_name)
+                exit(1)
+            trace_size = int(trace_size)
+        else:
+            print("Error: Unknown flag %s" % flag)
+            usage(compiler_name)
+            exit(1)
+
     if subcommand == "sim":
         if len(argv) < 1:
             usage(compiler_name)
             print("Error: No input file provided for the simulation")
             exit(1)
         program_path, *argv = argv # extract file to input
-        program = load_program_from_file(program_path)
-        simulate_program(program)
+        program = load_program(program_path, use_cache)
+        analyze_stack(program)
+        if fold and batch_path is not None:
+            print("Error: --batch replaces literals that --fold would have folded away, use one or the other")
+            exit(1)
+        if fold:
+            (program, _) = fold_program(program)
+            analyze_stack(program)
+        if profile_path is not None or trace_size is not None:
+            if jit or batch_path is not None or (profile_path is not None and trace_size is not None):
+                print("Error: --profile and --trace run their own engines and can't be combined with each other, --jit or --batch")
+                exit(1)
+        if trace_size is not None:
+            simulate = lambda program, out=None: trace_program(program, trace_size, out)
+        elif profile_path is not None:
+            if profile_path == "":
+                profile_path = path.splitext(path.basename(program_path))[0] + ".folded"
+            simulate = partial(simulate_profiled, folded_path=profile_path)
+        else:
+            simulate = SIM_ENGINES[engine]
+        if fuse:
+            simulate = partial(simulate_fused, simulate=simulate, print_stats=fuse_stats)
+        if batch_path is not None:
+            (ips, lanes) = load_batch_seeds(program, batch_path)
+            simulate_program_batch(program, ips, lanes) # Runs the unfused program, the engine is not used
+        elif jit:
+            simulate_program_jit(program, simulate) # Translates the unfused program, fusion only helps the interpreters
+        else:
+            simulate(program)
     elif subcommand == "com":
         if len(argv) < 1:
             usage(compiler_name)
             print("Error: No input file provided for the compiler")
             exit(1)
-        program_path, *argv = argv
-        program = load_program_from_file(program_path)
-        porth_ext = '.porth'
-        basename = path.basename(program_path)
-        if basename.endswith(porth_ext):
-            basename = basename[:-len(porth_ext)]
-        print("[INFO] Generating %s" % (basename + ".asm"))
-        compile_program(program, basename + ".asm")
-        call_echoed(["nasm", "-felf64", basename + ".asm"])
-        call_echoed(["ld", basename + ".o", "-o", basename])
+        if backend == "c" and (tos_cache or not peephole):
+            print("Error: --tos-cache and --no-peephole change the assembly, the c backend doesn't write any")
+            exit(1)
+        options = {"use_cache": use_cache, "fold": fold, "tos_cache": tos_cache, "peephole": peephole, "backend": backend}
+        if not com_programs(argv, out_dir, jobs, **options):
+            exit(1)
+    elif subcommand == "test":
+        paths = argv or [path.relpath(path.join(path.dirname(__file__), "examples"))]
+        flags = ([] if use_cache else ["--no-cache"]) + ["--backend=%s" % backend]
+        if not test_programs(paths, record, flags):
+            exit(1)
     elif subcommand == "help":
         usage(compiler_name)
         exit(0)